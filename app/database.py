@@ -1,29 +1,127 @@
+import asyncio
+import json
+import random
+
+import asyncpg
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncAttrs, AsyncSession
 from sqlalchemy.orm import DeclarativeBase
 from app.config import settings
 
-engine = create_async_engine(settings.database_url, echo=False, pool_pre_ping=True, future=True)
-async_session = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+engine = create_async_engine(
+    settings.database_url,
+    echo=False,
+    pool_pre_ping=True,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_recycle=settings.db_pool_recycle,  # не держим соединения дольше 30 мин — Postgres/NAT их рвут
+    pool_timeout=settings.db_pool_timeout,
+    connect_args={"prepared_statement_cache_size": settings.db_statement_cache_size},
+    query_cache_size=1200,  # кэш скомпилированных запросов: по умолчанию 500, у бота их больше
+    future=True,
+)
+# autoflush=False: без неявных flush перед каждым запросом; где нужен id — flush() вызывается явно
+async_session = async_sessionmaker(engine, expire_on_commit=False, autoflush=False, class_=AsyncSession)
 
 class Base(AsyncAttrs, DeclarativeBase):
     pass
 
-# >>> ДОБАВЬ ЭТУ ЧАСТЬ <<<
-import asyncio
-async def wait_for_db(retries: int = 40, delay: float = 1.0):
+# Отдельный asyncpg-пул для частых read-only запросов (без ORM-гидрации).
+# Записи и транзакции — по-прежнему через async_session.
+pg_pool: asyncpg.Pool | None = None
+
+async def _init_pg_conn(conn: asyncpg.Connection) -> None:
+    # Вызывается один раз на новое соединение, а не на каждый acquire/запрос
+    await conn.execute("SET TIME ZONE 'UTC'")
+    for typename in ("json", "jsonb"):
+        await conn.set_type_codec(typename, encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+async def init_pg_pool() -> asyncpg.Pool:
+    global pg_pool
+    if pg_pool is None:
+        # asyncpg не понимает драйверный префикс SQLAlchemy
+        dsn = settings.database_url.replace("+asyncpg", "", 1)
+        pg_pool = await asyncpg.create_pool(
+            dsn,
+            min_size=5,
+            max_size=20,
+            max_inactive_connection_lifetime=600,
+            statement_cache_size=1024,
+            init=_init_pg_conn,
+        )
+    return pg_pool
+
+async def close_pg_pool() -> None:
+    global pg_pool
+    if pg_pool is not None:
+        await pg_pool.close()
+        pg_pool = None
+
+async def fetch_user(tg_id: int) -> asyncpg.Record | None:
+    if pg_pool is None:
+        raise RuntimeError("pg_pool is not initialized, call init_pg_pool() first")
+    async with pg_pool.acquire() as conn:
+        return await conn.fetchrow(
+            "SELECT id, tg_id, balance, referral_code, is_admin, subscription_until FROM users WHERE tg_id = $1",
+            tg_id,
+        )
+
+async def fetch_referral_code(tg_id: int) -> str | None:
+    # одно поле — без разбора всей строки пользователя
+    if pg_pool is None:
+        raise RuntimeError("pg_pool is not initialized, call init_pg_pool() first")
+    async with pg_pool.acquire() as conn:
+        return await conn.fetchval("SELECT referral_code FROM users WHERE tg_id = $1", tg_id)
+
+async def fetch_open_payment(
+    user_id: int, purpose: str, tariff_id: int | None, amount, since,
+) -> asyncpg.Record | None:
+    # недавний неоплаченный счёт за ту же покупку (с той же суммой), у которого есть ссылка на оплату
+    if pg_pool is None:
+        raise RuntimeError("pg_pool is not initialized, call init_pg_pool() first")
+    async with pg_pool.acquire() as conn:
+        return await conn.fetchrow(
+            "SELECT yk_payment_id, status, confirmation_url, created_at FROM payments "
+            "WHERE status = 'pending' AND created_at > $5 AND user_id = $1 AND purpose = $2 "
+            "AND tariff_id IS NOT DISTINCT FROM $3 AND amount = $4 AND confirmation_url IS NOT NULL "
+            "ORDER BY created_at DESC LIMIT 1",
+            user_id, purpose, tariff_id, amount, since,
+        )
+
+async def wait_for_db(retries: int = 40, initial: float = 0.5, max_delay: float = 10.0):
+    """
+    Ждём, пока Postgres начнёт принимать соединения.
+    Пауза растёт экспоненциально (с небольшим джиттером), но не больше max_delay.
+    """
     last_err = None
-    for _ in range(retries):
+    for i in range(retries):
         try:
             async with engine.connect() as conn:
-                await conn.execute("SELECT 1")
+                await conn.execute(text("SELECT 1"))
             return
         except Exception as e:
             last_err = e
-            await asyncio.sleep(delay)
+            await asyncio.sleep(min(initial * 2 ** i, max_delay) + random.random() * 0.25)
     raise last_err
 
+# create_all не меняет существующие таблицы — догоняем схему старых баз вручную
+_SCHEMA_PATCHES = (
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS active_until TIMESTAMPTZ "
+    "GENERATED ALWAYS AS (GREATEST(subscription_until, extra_devices_until)) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_users_active_until_tg ON users (active_until) INCLUDE (id, tg_id)",
+    # прежний индекс без tg_id поглощён новым
+    "DROP INDEX IF EXISTS ix_users_active_until",
+    "CREATE INDEX IF NOT EXISTS ix_nodes_active_load ON nodes (load) WHERE is_active",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_lower ON users (lower(username))",
+    "CREATE INDEX IF NOT EXISTS ix_payments_status_created ON payments (status, created_at) "
+    "INCLUDE (id, amount, purpose, yk_payment_id)",
+)
+
 async def init_db():
     # Import models so metadata is populated
     from app import models  # noqa
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        for ddl in _SCHEMA_PATCHES:
+            await conn.execute(text(ddl))
+    await init_pg_pool()
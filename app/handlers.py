@@ -1,8 +1,13 @@
+from __future__ import annotations
+
 import asyncio
-import io
+import logging
+import time
 from datetime import datetime, timedelta, timezone
+from dataclasses import dataclass
 from decimal import Decimal
-from typing import Optional, List
+from functools import lru_cache, partial
+from typing import TYPE_CHECKING, Optional, List, Tuple
 
 from telegram import (
     Update,
@@ -10,59 +15,237 @@ from telegram import (
     InlineKeyboardMarkup,
     InputFile,
 )
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import (
     ContextTypes,
     CommandHandler,
     CallbackQueryHandler,
     Application,
 )
-from sqlalchemy import asc, select, func, and_, or_
+from cachetools import TTLCache
+from sqlalchemy import asc, bindparam, case, delete, literal_column, select, func, and_, or_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import NoResultFound
 from app.config import settings
-from app.database import async_session
+from app.database import async_session, fetch_open_payment, fetch_referral_code, fetch_user
 import app.models as M
 from app.models import Node, User, Tariff, Device, Payment
 from app.utils import rub, gen_ref_code
-from app.wg_api import WGEasyClient
-from app.payments import YooKassaClient
-from app.wg_api import WGEasyError
 from zoneinfo import ZoneInfo
+
+if TYPE_CHECKING:
+    from app.wg_api import WGEasyClient
+    from app.payments import YooKassaClient
+
+log = logging.getLogger(__name__)
+
+# tzdata читаем один раз, а не на каждое форматирование даты
+TZ = ZoneInfo(settings.tz)
+# текущее время в UTC: partial без лишнего Python-кадра и поиска timezone на каждый вызов
+utcnow = partial(datetime.now, timezone.utc)
+
+# Денежные константы бизнес-правил: Decimal парсим один раз, а не на каждый платёж
+REF_BONUS_FRACTION = (Decimal(settings.referral_bonus_percent) / Decimal(100)).quantize(Decimal("0.0001"))
+DEVICE_EXTRA = Decimal(str(settings.device_extra_price))
+REF_REFERRER_FIXED = Decimal(settings.ref_referrer_fixed_rub)
+CENT = Decimal("0.01")
+ZERO = Decimal(0)
+
+# Сроки: один объект timedelta на процесс вместо нового на каждое продление
+DAY = timedelta(days=1)
+EXTRA_DEVICE_PERIOD = timedelta(days=30)
+
+def _extend_from(until: Optional[datetime], delta: timedelta, now: datetime) -> datetime:
+    """Продлевает срок на delta от текущего конца, а если он уже прошёл — от now."""
+    return (until if until and until > now else now) + delta
+
 # === singletons ===
-wg_client = WGEasyClient(settings.wg_url, settings.wg_password)
-yk_client = YooKassaClient(settings.yk_shop_id, settings.yk_secret_key)
-user_payment_tasks = {}
+@lru_cache(maxsize=1)
+def get_wg_client() -> WGEasyClient:
+    # клиент (и его модуль) создаётся при первом обращении, а не при импорте хендлеров
+    from app.wg_api import WGEasyClient
+    return WGEasyClient(settings.wg_url, settings.wg_password)
+
+# клиенты нод: один на ноду, чтобы cookie-сессия и keep-alive жили между удалениями
+_wg_clients: dict[int, WGEasyClient] = {}
+
+async def _get_node_client(node: Node) -> WGEasyClient:
+    c = _wg_clients.get(node.id)
+    # адрес/пароль ноды могли поменять в БД — тогда заводим клиента заново
+    if c is None or c.base_url != node.api_url.rstrip("/") or c.password != node.api_password:
+        if c is not None:
+            await c.close()
+        from app.wg_api import WGEasyClient
+        c = WGEasyClient(node.api_url, node.api_password)
+        _wg_clients[node.id] = c
+    return c
+
+async def close_wg_clients() -> None:
+    clients = list(_wg_clients.values())
+    _wg_clients.clear()
+    if get_wg_client.cache_info().currsize:
+        clients.append(get_wg_client())
+    for c in clients:
+        await c.close()
+
+@lru_cache(maxsize=1)
+def _get_yk_client() -> YooKassaClient:
+    from app.payments import YooKassaClient
+    return YooKassaClient(settings.yk_shop_id, settings.yk_secret_key)
+
 BOT_BROADCAST_HEADER = "📣 Сообщение от VPN-сервиса\n\n"  # шапка, чтобы было видно «от бота»
 
+# ---------------------------
+# Prebuilt statements
+# ---------------------------
+# Собираем один раз на уровне модуля, параметры передаём при execute —
+# SQLAlchemy не строит выражение заново и сразу попадает в кеш компиляции.
+_STMT_USER_BY_TG = select(User).where(User.tg_id == bindparam("tg_id"))
+_STMT_IS_ADMIN = select(User.is_admin).where(User.tg_id == bindparam("tg_id"))
+# главное меню: нужные поля пользователя и число его устройств за один запрос — Row без ORM-гидрации
+_STMT_USER_MENU = select(
+    User.is_admin,
+    User.balance,
+    User.subscription_until,
+    User.device_quota,
+    User.extra_devices_until,
+    User.extra_devices_count,
+    select(func.count(Device.id)).where(Device.user_id == User.id).scalar_subquery().label("used_count"),
+).where(User.tg_id == bindparam("tg_id"))
+# меню устройств: пользователь и его устройства одним запросом (без устройств — одна строка с Device=None);
+# порядок — по дате создания, его же использует разметка бесплатных/платных слотов
+_STMT_USER_WITH_DEVICES = (
+    select(User, Device)
+    .outerjoin(Device, Device.user_id == User.id)
+    .where(User.tg_id == bindparam("tg_id"))
+    .order_by(Device.created_at.asc().nulls_first(), Device.id)
+)
+# enforce_user_devices: старые устройства остаются, лишние — самые новые
+_STMT_ENFORCE_DEVICES = (
+    select(Device.id, Device.wg_client_id, Device.is_extra)
+    .where(Device.user_id == bindparam("uid"))
+    .order_by(Device.created_at.asc())
+)
+# удаление устройства: устройство и его нода (None, если нода не задана/удалена)
+_STMT_DEVICE_WITH_NODE = (
+    select(Device, Node)
+    .outerjoin(Node, Node.id == Device.node_id)
+    .where(Device.id == bindparam("dev_id"))
+)
+# device:add: пользователь и число его базовых/доп. устройств — одним запросом
+_STMT_USER_DEVICE_COUNTS = (
+    select(
+        User,
+        func.count(Device.id).filter(Device.is_extra.is_(False)),
+        func.count(Device.id).filter(Device.is_extra.is_(True)),
+    )
+    .outerjoin(Device, Device.user_id == User.id)
+    .where(User.tg_id == bindparam("tg_id"))
+    .group_by(User.id)
+)
+# карточка пользователя: сам пользователь и число его устройств за один запрос
+_STMT_USER_CARD = select(
+    User,
+    select(func.count(Device.id)).where(Device.user_id == User.id).scalar_subquery().label("used_count"),
+).where(User.id == bindparam("uid"))
+_STMT_PENDING_PAYMENTS = (
+    select(Payment.id, Payment.yk_payment_id)
+    .where(Payment.status == "pending")
+    .order_by(Payment.created_at)
+    .limit(20)
+)
+# владельцы и тарифы пачки платежей одним запросом (id платежа -> User, Tariff)
+_STMT_PAYMENT_TARGETS = (
+    select(Payment.id, User, Tariff)
+    .select_from(Payment)
+    .join(User, User.id == Payment.user_id)
+    .outerjoin(Tariff, Tariff.id == Payment.tariff_id)
+    .where(Payment.id.in_(bindparam("pids", expanding=True)))
+)
+_STMT_BEST_NODE = (
+    select(M.Node)
+    .where(
+        and_(
+            M.Node.is_active == True,
+            M.Node.load < M.Node.max_capacity  # <-- проверка лимита
+        )
+    )
+    .order_by(asc(M.Node.load))
+    .limit(1)  # нужна одна нода; по ix_nodes_active_load сервер остановится на первой строке
+)
+
 # ---------------------------
 # Small helpers (no stack)
 # ---------------------------
 
 async def pick_best_node(session: AsyncSession) -> M.Node | None:
-    result = await session.execute(
-        select(M.Node)
-        .where(
-            and_(
-                M.Node.is_active == True,
-                M.Node.load < M.Node.max_capacity  # <-- проверка лимита
+    result = await session.execute(_STMT_BEST_NODE)
+    return result.scalar_one_or_none()
+
+# Тарифы — справочные данные, меняются редко: держим активные в памяти на минуту.
+# Кешируем лёгкие неизменяемые объекты, а не ORM-инстансы (те привязаны к сессии).
+@dataclass(slots=True, frozen=True)
+class TariffView:
+    id: int
+    name: str
+    days: int
+    price: Decimal
+    max_devices: int
+
+_tariff_cache: TTLCache = TTLCache(maxsize=256, ttl=60)
+
+async def list_active_tariffs() -> list[TariffView]:
+    tariffs = _tariff_cache.get("all_active")
+    if tariffs is None:
+        async with async_session() as session:
+            res = await session.execute(
+                select(Tariff.id, Tariff.name, Tariff.days, Tariff.price, Tariff.max_devices)
+                .where(Tariff.is_active == True)
+                .order_by(Tariff.days)
             )
-        )
-        .order_by(asc(M.Node.load))
-    )
-    return result.scalars().first()
-
-def _extra_active(u: M.User) -> bool:
-    return bool(u.extra_devices_until and u.extra_devices_until > datetime.now(timezone.utc))
+            tariffs = [TariffView(**row._mapping) for row in res.all()]
+        _tariff_cache["all_active"] = tariffs
+        _tariff_cache["by_id"] = {t.id: t for t in tariffs}
+    return tariffs
+
+async def tariffs_markup() -> InlineKeyboardMarkup:
+    # клавиатура выбора тарифа живёт в том же кеше и пересобирается вместе со списком
+    kb = _tariff_cache.get("markup")
+    if kb is None:
+        rows = [[InlineKeyboardButton(
+                    f"{t.name} — {rub(t.price)} ({t.max_devices} устр.)",
+                    callback_data=f"tariff:buy:{t.id}"
+                )] for t in await list_active_tariffs()]
+        rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="menu:main")])
+        kb = InlineKeyboardMarkup(rows)
+        _tariff_cache["markup"] = kb
+    return kb
+
+async def get_active_tariff(tariff_id: int) -> TariffView | None:
+    by_id = _tariff_cache.get("by_id")
+    if by_id is None:
+        # записи кеша истекают независимо — индекс строим из (возможно, ещё живого) списка
+        by_id = {t.id: t for t in await list_active_tariffs()}
+        _tariff_cache["by_id"] = by_id
+    return by_id.get(tariff_id)
+
+# now можно передать из хендлера: одно «сейчас» на весь запрос
+def _extra_active(u: M.User, now: Optional[datetime] = None) -> bool:
+    now = now or utcnow()
+    return bool(u.extra_devices_until and u.extra_devices_until > now)
 
 def _base_quota(u: M.User) -> int:
     return int(u.device_quota or 0)
 
-def _extra_quota(u: M.User) -> int:
-    return int(u.extra_devices_count or 0) if _extra_active(u) else 0
+def _extra_quota(u: M.User, now: Optional[datetime] = None) -> int:
+    return int(u.extra_devices_count or 0) if _extra_active(u, now) else 0
 
-def _has_extra(u: User) -> bool:
+def _has_extra(u: User, now: Optional[datetime] = None) -> bool:
+    now = now or utcnow()
     return bool(
         getattr(u, "extra_devices_until", None)
-        and u.extra_devices_until > datetime.now(timezone.utc)
+        and u.extra_devices_until > now
         and (getattr(u, "extra_devices_count", 0) or 0) > 0
     )
 
@@ -71,124 +254,236 @@ def safe_username(u):
 
 import html
 
-# Функция отмены
-async def cancel_user_payment_check(user_id):
-    if user_id in user_payment_tasks:
-        user_payment_tasks[user_id].cancel()
-        try:
-            await user_payment_tasks[user_id]
-        except asyncio.CancelledError:
-            pass
+# ---------------------------
+# Ожидание оплаты: одна фоновая задача на все счета
+# ---------------------------
+PAYMENT_WATCH_TIMEOUT = 600  # 10 минут в секундах
+# опрос с экспоненциальной паузой: 3с → ×1.5 → не больше 30с; сброс при смене статуса
+_POLL_BASE, _POLL_MAX, _POLL_BACKOFF = 3.0, 30.0, 1.5
 
-async def auto_check_payment(application, payment_id: str, user_id: int, yk_client):
-    start_time = asyncio.get_event_loop().time()
-    timeout = 600  # 10 минут в секундах
-    
-    print(f'🎯 Запуск проверки для payment {payment_id}, user {user_id}')
-    print(f'📊 Активные задачи: {list(user_payment_tasks.keys())}')
+_STMT_WATCHED_PAYMENTS = (
+    select(Payment.id, Payment.yk_payment_id, Payment.status)
+    .where(Payment.yk_payment_id.in_(bindparam("yk_ids", expanding=True)))
+)
+
+@dataclass(slots=True)
+class _PaymentWatch:
+    yk_payment_id: str
+    query: object  # CallbackQuery: через него правим сообщение со счётом
+    deadline: float
+    next_check: float
+    interval: float = _POLL_BASE
+    status: Optional[str] = None
+
+# user_id -> ожидаемый платёж (новый счёт пользователя заменяет предыдущий)
+_payment_watches: dict[int, _PaymentWatch] = {}
+_watchdog_task: Optional[asyncio.Task] = None
+
+def watch_payment(query, user_id: int, yk_payment_id: str, created_at: Optional[datetime] = None) -> None:
+    """
+    Ставит счёт на отслеживание и при необходимости запускает payment_watchdog.
+    created_at — для повторно выданного счёта: срок считаем от его создания, а не от нового нажатия.
+    """
+    global _watchdog_task
+    now = time.monotonic()
+    timeout = PAYMENT_WATCH_TIMEOUT
+    if created_at is not None:
+        timeout -= (utcnow() - created_at).total_seconds()
+    _payment_watches[user_id] = _PaymentWatch(
+        yk_payment_id=yk_payment_id,
+        query=query,
+        deadline=now + timeout,
+        next_check=now + _POLL_BASE,
+    )
+    log.debug("watch payment %s for user %s, watched: %d", yk_payment_id, user_id, len(_payment_watches))
+    if _watchdog_task is None or _watchdog_task.done():
+        _watchdog_task = asyncio.create_task(payment_watchdog(), name="payment-watchdog")
 
+async def get_or_create_payment(
+    user_id: int, purpose: str, tariff_id: Optional[int], amount: Decimal, make,
+) -> tuple[dict, bool]:
+    """
+    Повторное нажатие «Купить», пока прежний счёт за ту же покупку ещё ждёт оплаты
+    (в пределах PAYMENT_WATCH_TIMEOUT), возвращает этот счёт, а не выставляет второй в YooKassa.
+    Апдейты PTB обрабатываются по одному, так что двойной клик — это два последовательных вызова,
+    и второй находит запись Payment, сохранённую первым.
+    Возвращает (счёт в формате ответа YooKassa, is_new): is_new=True — счёт новый, его надо записать в БД.
+    """
+    since = utcnow() - timedelta(seconds=PAYMENT_WATCH_TIMEOUT)
+    row = await fetch_open_payment(user_id, purpose, tariff_id, amount, since)
+    if row is not None:
+        return {
+            "id": row["yk_payment_id"],
+            "status": row["status"],
+            "confirmation": {"confirmation_url": row["confirmation_url"]},
+            "created_at": row["created_at"],  # datetime: от него считается срок наблюдения за счётом
+        }, False
+    return await make(), True
+
+# Функция отмены: просто снимаем счёт с наблюдения, ждать нечего
+def cancel_user_payment_check(user_id: int) -> None:
+    _payment_watches.pop(user_id, None)
+
+# итоговые клавиатуры счёта
+_KB_PAID = InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Открыть меню", callback_data="menu:main")]])
+_KB_CANCELED = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Попробовать снова", callback_data="menu:tariffs")],
+    [InlineKeyboardButton("🏠 В меню", callback_data="menu:main")],
+])
+_KB_TIMEOUT = InlineKeyboardMarkup([[InlineKeyboardButton("🏠 В меню", callback_data="menu:main")]])
+
+# отложенные правки сообщений счетов (после RetryAfter); ссылки держим, чтобы задачи не собрал GC
+_watch_edit_tasks: set[asyncio.Task] = set()
+
+async def _edit_watch_message(
+    w: _PaymentWatch, text: str, markup: InlineKeyboardMarkup, retry: bool = True,
+) -> None:
     try:
-        while True:
-            # Проверяем таймаут
-            current_time = asyncio.get_event_loop().time()
-            if current_time - start_time > timeout:
-                # Время вышло, отменяем платеж
-                async with async_session() as session:
-                    p = (await session.execute(
-                        select(Payment).where(Payment.yk_payment_id == payment_id)
-                    )).scalar_one_or_none()
-                    
-                    # Отправляем сообщение пользователю
-                    try:
-                        await application.edit_message_text(
+        await w.query.edit_message_text(text, reply_markup=markup)
+    except RetryAfter as e:
+        if not retry:
+            log.warning("payment %s: message edit dropped, flood control: %s", w.yk_payment_id, e)
+            return
+        # флуд-контроль одного чата не должен останавливать тик: повторяем правку в фоне
+        task = asyncio.create_task(_retry_watch_edit(w, text, markup, _retry_after_s(e)))
+        _watch_edit_tasks.add(task)
+        task.add_done_callback(_watch_edit_tasks.discard)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            log.warning("payment %s: message edit failed: %s", w.yk_payment_id, e)
+    except TelegramError as e:
+        # пользователь удалил чат/заблокировал бота — остальным счетам это не мешает
+        log.warning("payment %s: message edit failed: %s", w.yk_payment_id, e)
+
+async def _retry_watch_edit(w: _PaymentWatch, text: str, markup: InlineKeyboardMarkup, delay: float) -> None:
+    # ждём, сколько просит Telegram, и пробуем ещё раз — уже без повторов
+    await asyncio.sleep(delay)
+    await _edit_watch_message(w, text, markup, retry=False)
+
+async def _check_watches(session: AsyncSession, due: dict[int, _PaymentWatch], now: float) -> None:
+    # один SELECT на все счета, у которых подошло время проверки
+    rows = {
+        r.yk_payment_id: r
+        for r in (await session.execute(
+            _STMT_WATCHED_PAYMENTS, {"yk_ids": [w.yk_payment_id for w in due.values()]}
+        )).all()
+    }
+    live = {}
+    for uid, w in due.items():
+        r = rows.get(w.yk_payment_id)
+        if not r or r.status in ("succeeded", "canceled"):
+            # платёж удалён или уже обработан (например, poll_pending_payments)
+            _payment_watches.pop(uid, None)
+        else:
+            live[uid] = (w, r)
+    if not live:
+        return
+
+    # статусы YooKassa — параллельно
+    yk = _get_yk_client()
+    results = await asyncio.gather(
+        *(yk.get_payment(w.yk_payment_id) for w, _ in live.values()), return_exceptions=True
+    )
+
+    changed: dict[str, list[int]] = {}
+    finished = []
+    for (uid, (w, r)), info in zip(live.items(), results):
+        if _payment_watches.get(uid) is not w:
+            continue  # пока ждали YooKassa, проверку отменили или заменили
+        if isinstance(info, BaseException):
+            log.warning("payment %s status fetch failed: %s", w.yk_payment_id, info)
+            w.interval = min(w.interval * _POLL_BACKOFF, _POLL_MAX)
+            w.next_check = now + w.interval
+            continue
+        status = info.get("status", "pending")
+        if w.status is None:
+            w.status = r.status
+        if status != w.status:
+            # статус сменился — запишем и снова опрашиваем часто
+            changed.setdefault(status, []).append(r.id)
+            w.status = status
+            w.interval = _POLL_BASE
+        else:
+            w.interval = min(w.interval * _POLL_BACKOFF, _POLL_MAX)
+        w.next_check = now + w.interval
+        if status in ("succeeded", "canceled"):
+            finished.append((uid, w, r.id))
+
+    # по одному UPDATE на каждый новый статус; RETURNING — какие строки сменили статус именно здесь
+    ts = utcnow()
+    applied: dict[int, Payment] = {}
+    for status, ids in changed.items():
+        applied.update((p.id, p) for p in (await session.execute(
+            update(Payment).where(Payment.id.in_(ids), Payment.status != status)
+            .values(status=status, updated_at=ts)
+            .returning(Payment)
+        )).scalars())
+    # успех, уже записанный poll_pending_payments, повторно не применяем
+    succeeded = [applied[pid] for _, w, pid in finished if w.status == "succeeded" and pid in applied]
+    targets = await _preload_payment_targets(session, succeeded)
+    for p in succeeded:
+        await _apply_successful_payment(session, p, *targets[p.id])
+    await session.commit()
+
+    for uid, w, _ in finished:
+        _payment_watches.pop(uid, None)
+        if w.status == "succeeded":
+            log.info("payment %s succeeded", w.yk_payment_id)
+            await _edit_watch_message(w, "✅ Оплата прошла успешно!", _KB_PAID)
+        else:
+            log.info("payment %s canceled", w.yk_payment_id)
+            await _edit_watch_message(w, "❌ Оплата отменена.", _KB_CANCELED)
+
+async def payment_watchdog():
+    """
+    Одна задача опрашивает все ожидающие счета (вместо задачи на каждого пользователя):
+    за тик — один SELECT, параллельные запросы в YooKassa и пакетный UPDATE.
+    Завершается, когда отслеживать больше нечего; watch_payment() запустит её снова.
+    """
+    async with async_session() as session:
+        while _payment_watches:
+            now = time.monotonic()
+            try:
+                for uid, w in list(_payment_watches.items()):
+                    if now > w.deadline:
+                        del _payment_watches[uid]
+                        await _edit_watch_message(
+                            w,
                             "⏰ Время оплаты истекло. Платеж отменен.\n\n"
                             "💡 Если вы хотели оплатить, создайте новый платеж.",
-                            reply_markup=InlineKeyboardMarkup([
-                                [InlineKeyboardButton("🏠 В меню", callback_data="menu:main")]
-                            ])
+                            _KB_TIMEOUT,
                         )
-                    except Exception:
-                        pass
-                return
 
-            async with async_session() as session:
-                p = (await session.execute(
-                    select(Payment).where(Payment.yk_payment_id == payment_id)
-                )).scalar_one_or_none()
-
-                if not p:
-                    return  # Платёж удалён или не найден
-
-                try:
-                    info = await yk_client.get_payment(payment_id)
-                except Exception as e:
-                    print(f"⚠️ Ошибка получения статуса платежа {payment_id}: {e}")
-                    await asyncio.sleep(15)
-                    continue
-
-                status = info.get("status", "pending")
-                p.status = status
-                p.updated_at = datetime.now(timezone.utc)
-                
-                # Выводим время до автоотмены
-                time_left = int(timeout - (current_time - start_time))
-                print(f'🔄 Проверка платежа {payment_id}. До отмены: {time_left} сек.')
-                
-                if status == "succeeded":
-                    print('✅ Оплата прошла успешно')
-                    await _apply_successful_payment(session, p)
-                    await session.commit()
-
-                    try:
-                        await application.edit_message_text(
-                            "✅ Оплата прошла успешно!",
-                            reply_markup=InlineKeyboardMarkup([
-                                [InlineKeyboardButton("🏠 Открыть меню", callback_data="menu:main")]
-                            ])
-                        )
-                    except Exception:
-                        pass
-                    return
-
-                elif status == "canceled":
-                    print('❌ Оплата отменена.')
-                    await session.commit()
-                    try:
-                        await application.edit_message_text(
-                            "❌ Оплата отменена.",
-                            reply_markup=InlineKeyboardMarkup([
-                                [InlineKeyboardButton("🔄 Попробовать снова", callback_data="menu:tariffs")],
-                                [InlineKeyboardButton("🏠 В меню", callback_data="menu:main")]
-                            ])
-                        )
-                    except Exception:
-                        pass
-                    return
-
-            await asyncio.sleep(10)
-            
-    except asyncio.CancelledError:
-        # Задача была отменена вручную
-        print(f"⏹️ Проверка платежа {payment_id} отменена вручную")
-    except Exception as e:
-        print(f"❌ Критическая ошибка в auto_check_payment: {e}")
-    finally:
-        # Очищаем только если это текущая активная задача
-        if user_id in user_payment_tasks and user_payment_tasks[user_id] == asyncio.current_task():
-            del user_payment_tasks[user_id]
-            print(f"🧹 Задача для user {user_id} очищена")
-        print(f'📋 Осталось задач: {list(user_payment_tasks.keys())}')
+                due = {uid: w for uid, w in _payment_watches.items() if w.next_check <= now}
+                if due:
+                    await _check_watches(session, due, now)
+            except Exception:
+                log.exception("payment_watchdog tick failed")
+            finally:
+                # сессия одна на весь цикл, поэтому транзакция тика завершается здесь на любом выходе
+                # (успех — уже commit, ранний выход после SELECT или ошибка — rollback):
+                # без транзакции AsyncSession отдаёт соединение в пул на время сна; identity map не растёт
+                if session.in_transaction():
+                    await session.rollback()
+                session.expunge_all()
+
+            # просыпаемся к ближайшей проверке, но не реже базового интервала (для новых счетов)
+            wake = min((w.next_check for w in _payment_watches.values()), default=now)
+            await asyncio.sleep(min(max(wake - time.monotonic(), 0.5), _POLL_BASE))
+
+PAYMENT_PURPOSE_LABELS = {
+    "TARIFF": "🧾 Подписки",
+    "EXTRA_DEVICE": "🧩 Доп. устройства",
+    "TOPUP": "💰 Пополнения",
+}
 
 async def _render_admin_payments(query, tg_user_id: int, kind: str = "today"):
     # права
     async with async_session() as session:
-        admin = (await session.execute(
-            select(User).where(User.tg_id == tg_user_id))
-        ).scalar_one_or_none()
-        if not admin or not admin.is_admin:
+        if not await is_admin_tg(tg_user_id, session):
             await query.edit_message_text(
                 "❌ Недостаточно прав.",
-                reply_markup=InlineKeyboardMarkup([back_to_admin()])
+                reply_markup=KB_BACK_ADMIN_ONLY
             )
             return
 
@@ -197,52 +492,45 @@ async def _render_admin_payments(query, tg_user_id: int, kind: str = "today"):
         if start is not None:
             conds.append(Payment.created_at >= start)
 
-        total_count = (await session.execute(
-            select(func.count(Payment.id)).where(and_(*conds))
-        )).scalar_one()
-
-        total_sum = (await session.execute(
-            select(func.coalesce(func.sum(Payment.amount), 0)).where(and_(*conds))
-        )).scalar_one()
-
-        # Разделяем YooKassa и Баланс
-        external_sum = (await session.execute(
-            select(func.coalesce(func.sum(Payment.amount), 0))
-            .where(and_(*conds, Payment.yk_payment_id.isnot(None)))
-        )).scalar_one()
-
-        balance_sum = float(total_sum) - float(external_sum)
-
-        breakdown = (await session.execute(
+        # одним запросом: строки по категориям + итоговая строка ROLLUP (grouping = 1)
+        rows = (await session.execute(
             select(Payment.purpose,
-                   func.count(Payment.id),
-                   func.coalesce(func.sum(Payment.amount), 0))
+                   func.grouping(Payment.purpose),
+                   # count(*): id не читаем — хватает покрывающего индекса
+                   func.count(),
+                   func.coalesce(func.sum(Payment.amount), 0),
+                   # YooKassa отдельно от оплат балансом
+                   func.coalesce(func.sum(Payment.amount).filter(Payment.yk_payment_id.isnot(None)), 0))
             .where(and_(*conds))
-            .group_by(Payment.purpose)
+            .group_by(func.rollup(Payment.purpose))
         )).all()
 
-    purpose_labels = {
-        "TARIFF": "🧾 Подписки",
-        "EXTRA_DEVICE": "🧩 Доп. устройства",
-        "TOPUP": "💰 Пополнения"
-    }
+    total_count, total_sum, external_sum = 0, 0, 0
+    breakdown = []
+    for purpose, is_total, cnt, summ, ext in rows:
+        if is_total:
+            total_count, total_sum, external_sum = cnt, summ, ext
+        else:
+            breakdown.append((purpose, cnt, summ))
+    # суммы NUMERIC приходят как Decimal — считаем и форматируем без float
+    balance_sum = total_sum - external_sum
 
     title = _payments_period_title(kind)
 
     lines = [
         f"💳 <b>Платежи {html.escape(title)}</b>",
         "",
-        f"Всего покупок: <b>{int(total_count)}</b>",
-        f"На сумму: <b>{float(total_sum):.2f} ₽</b>",
-        f"— С YooKassa: <b>{float(external_sum):.2f} ₽</b>",
-        f"— С баланса: <b>{float(balance_sum):.2f} ₽</b>",
+        f"Всего покупок: <b>{total_count}</b>",
+        f"На сумму: <b>{total_sum:.2f} ₽</b>",
+        f"— С YooKassa: <b>{external_sum:.2f} ₽</b>",
+        f"— С баланса: <b>{balance_sum:.2f} ₽</b>",
     ]
     if breakdown:
         lines.append("")
         lines.append("📊 По категориям:")
         for purpose, cnt, summ in breakdown:
-            label = purpose_labels.get(purpose, f"• {purpose}")
-            lines.append(f"{label}: <b>{int(cnt)}</b> шт. / <b>{float(summ):.2f} ₽</b>")
+            label = PAYMENT_PURPOSE_LABELS.get(purpose, f"• {purpose}")
+            lines.append(f"{label}: <b>{cnt}</b> шт. / <b>{summ:.2f} ₽</b>")
 
     await query.edit_message_text(
         "\n".join(lines),
@@ -251,24 +539,37 @@ async def _render_admin_payments(query, tg_user_id: int, kind: str = "today"):
     )
 
 
-def _has_base(u: User) -> bool:
-    return bool(u.subscription_until and u.subscription_until > datetime.now(timezone.utc))
+async def _debit_balance(session: AsyncSession, user_id: int, amount: Decimal) -> Decimal | None:
+    """
+    Списывает amount с баланса одним UPDATE ... RETURNING.
+    Возвращает новый баланс или None, если средств недостаточно.
+    """
+    return (await session.execute(
+        update(User).where(User.id == user_id, User.balance >= amount)
+        .values(balance=User.balance - amount)
+        .returning(User.balance)
+    )).scalar_one_or_none()
+
+def _has_base(u: User, now: Optional[datetime] = None) -> bool:
+    now = now or utcnow()
+    return bool(u.subscription_until and u.subscription_until > now)
+
+# параллельные удаления пиров ограничены: WG-Easy — один небольшой процесс на ноде
+WG_DELETE_CONCURRENCY = 8
+_wg_delete_sem = asyncio.Semaphore(WG_DELETE_CONCURRENCY)
 
 async def _delete_peer_safe(wg_client: WGEasyClient, client_id: str | None):
     if not client_id:
         return
     try:
-        await wg_client.delete_client(client_id)
+        async with _wg_delete_sem:
+            await wg_client.delete_client(client_id)
     except Exception:
         # уже удалено через UI — норм
         pass
 
-# handlers.py (или где у тебя эта функция)
-from sqlalchemy import and_
-from datetime import datetime, timezone
-
 async def enforce_user_devices(session, wg_client: WGEasyClient, user: M.User):
-    now = datetime.now(timezone.utc)
+    now = utcnow()
 
     base_active = bool(user.subscription_until and user.subscription_until > now)
     base_quota  = (user.device_quota or 0) if base_active else 0
@@ -280,49 +581,25 @@ async def enforce_user_devices(session, wg_client: WGEasyClient, user: M.User):
 
     #print(f"[enforce] uid={user.id} base_active={base_active} base_quota={base_quota} extra_active_count={extra_active_count}")
 
-    # --- базовые
-    res = await session.execute(
-        select(M.Device).where(and_(M.Device.user_id == user.id, M.Device.is_extra == False)).order_by(M.Device.created_at.asc())
-    )
-    base_devices = res.scalars().all()
+    # базовые и доп. устройства одним запросом, только нужные колонки; делим по is_extra в Python
+    base_devices, extra_devices = [], []
+    for d in (await session.execute(_STMT_ENFORCE_DEVICES, {"uid": user.id})).all():
+        (extra_devices if d.is_extra else base_devices).append(d)
 
-    if not base_active:
-        for d in base_devices:
-            #print(f"[enforce] delete BASE device id={d.id} wg_id={d.wg_client_id}")
-            await _delete_peer_safe(wg_client, d.wg_client_id)
-            await session.delete(d)
-        await session.commit()
-    else:
-        if len(base_devices) > base_quota:
-            to_remove = base_devices[base_quota:]
-            for d in to_remove:
-                #print(f"[enforce] trim BASE device id={d.id} wg_id={d.wg_client_id}")
-                await _delete_peer_safe(wg_client, d.wg_client_id)
-                await session.delete(d)
-            await session.commit()
+    # лишние сверх квоты (при неактивной подписке квота 0 — уходят все)
+    to_remove = base_devices[base_quota:] + extra_devices[max(extra_active_count, 0):]
+    if not to_remove:
+        return
 
-    # --- доп
-    res = await session.execute(
-        select(M.Device).where(and_(M.Device.user_id == user.id, M.Device.is_extra == True)).order_by(M.Device.created_at.asc())
+    # пиры в WG-Easy и записи в БД удаляем одновременно: HTTP-запросы к WG-Easy
+    # идут параллельно друг другу и единственному DELETE в сессии; коммит — один
+    await asyncio.gather(
+        asyncio.gather(*(_delete_peer_safe(wg_client, d.wg_client_id) for d in to_remove), return_exceptions=True),
+        session.execute(delete(M.Device).where(M.Device.id.in_([d.id for d in to_remove]))),
     )
-    extra_devices = res.scalars().all()
-
-    if extra_active_count <= 0:
-        for d in extra_devices:
-            #print(f"[enforce] delete EXTRA device id={d.id} wg_id={d.wg_client_id}")
-            await _delete_peer_safe(wg_client, d.wg_client_id)
-            await session.delete(d)
-        await session.commit()
-    else:
-        if len(extra_devices) > extra_active_count:
-            to_remove = extra_devices[extra_active_count:]
-            for d in to_remove:
-                #print(f"[enforce] trim EXTRA device id={d.id} wg_id={d.wg_client_id}")
-                await _delete_peer_safe(wg_client, d.wg_client_id)
-                await session.delete(d)
-            await session.commit()
+    await session.commit()
 
-def fmt_human(dt, tz_name: str = "Europe/Moscow") -> str:
+def fmt_human(dt, tz_name: str | None = None) -> str:
     """
     Превращает datetime в вид 'DD.MM.YYYY HH:MM (TZ)'.
     Поддерживает naive/aware. Если dt = None — вернёт '—'.
@@ -332,21 +609,39 @@ def fmt_human(dt, tz_name: str = "Europe/Moscow") -> str:
     if dt.tzinfo is None:
         # считаем, что в базе время хранится в UTC (если иначе — поправь тут)
         dt = dt.replace(tzinfo=timezone.utc)
-    tz = ZoneInfo(tz_name)
+    tz = TZ if tz_name is None else ZoneInfo(tz_name)
     local = dt.astimezone(tz)
-    return local.strftime("%d.%m.%Y %H:%M")
+    # f-строка вместо strftime: формат фиксированный, локаль не нужна
+    return f"{local.day:02d}.{local.month:02d}.{local.year} {local.hour:02d}:{local.minute:02d}"
 
 def kb(rows: list[list[InlineKeyboardButton]]) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
+# кнопки неизменяемые — создаём один раз, в строку кладём тот же объект
+_BTN_BACK_MAIN = InlineKeyboardButton("⬅️ Назад", callback_data="menu:main")
+_BTN_BACK_ADMIN = InlineKeyboardButton("⬅️ Назад", callback_data="menu:admin")
+
 def back_to_main() -> List[InlineKeyboardButton]:
-    return [InlineKeyboardButton("⬅️ Назад", callback_data="menu:main")]
+    return [_BTN_BACK_MAIN]
 
 def back_to_admin() -> List[InlineKeyboardButton]:
-    return [InlineKeyboardButton("⬅️ Назад", callback_data="menu:admin")]
+    return [_BTN_BACK_ADMIN]
+
+# типовые клавиатуры возврата — собираются один раз
+KB_BACK_MAIN_ONLY = kb([back_to_main()])
+KB_BACK_ADMIN_ONLY = kb([back_to_admin()])
+KB_BACK_TO_TARIFFS_ONLY = kb([[InlineKeyboardButton("⬅️ Назад", callback_data="menu:tariffs")]])
+KB_BACK_TO_TARIFFS = kb([[InlineKeyboardButton("⬅️ Назад", callback_data="menu:tariffs")], back_to_main()])
+KB_BACK_TO_DEVICES = kb([[InlineKeyboardButton("🖥 К устройствам", callback_data="menu:devices")], back_to_main()])
+KB_TO_MAIN_ONLY = kb([[InlineKeyboardButton("🏠 В меню", callback_data="menu:main")]])
+KB_TO_DEVICES_ONLY = kb([[InlineKeyboardButton("🖥 К устройствам", callback_data="menu:devices")]])
+KB_NEED_SUBSCRIPTION = kb([
+    [InlineKeyboardButton("💰 К подпискам", callback_data="menu:tariffs")],
+    [InlineKeyboardButton("🏠 Меню", callback_data="menu:main")],
+])
 
 def _period_bounds(kind: str) -> tuple[datetime | None, datetime]:
-    now = datetime.now(timezone.utc)
+    now = utcnow()
     if kind == "today":
         return now.replace(hour=0, minute=0, second=0, microsecond=0), now
     if kind == "month":
@@ -363,38 +658,48 @@ def _payments_period_title(kind: str) -> str:
         "all": "за всё время",
     }.get(kind, "за всё время")
 
+PAYMENTS_KBD_MARKUP = kb([
+    [
+        InlineKeyboardButton("📅 Сегодня", callback_data="admin:payments:period:today"),
+        InlineKeyboardButton("📅 Месяц", callback_data="admin:payments:period:month"),
+    ],
+    [
+        InlineKeyboardButton("📆 Год", callback_data="admin:payments:period:year"),
+        InlineKeyboardButton("📅 Всё время", callback_data="admin:payments:period:all"),
+    ],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="admin:payments_list")],
+])
+
 def _payments_kbd() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("📅 Сегодня", callback_data="admin:payments:period:today"),
-            InlineKeyboardButton("📅 Месяц", callback_data="admin:payments:period:month"),
-        ],
-        [
-            InlineKeyboardButton("📆 Год", callback_data="admin:payments:period:year"),
-            InlineKeyboardButton("📅 Всё время", callback_data="admin:payments:period:all"),
-        ],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="admin:payments_list")],
-    ])
-
-async def require_admin(update, session) -> bool:
-    me = (await session.execute(select(User).where(User.tg_id == update.effective_user.id))).scalar_one_or_none()
-    return bool(me and me.is_admin)
-
-async def get_user_by_id(session, uid: int) -> User | None:
-    return (await session.execute(select(User).where(User.id == uid))).scalar_one_or_none()
+    return PAYMENTS_KBD_MARKUP
+
+# права админа меняются вручную в БД и редко: держим флаг в памяти минуту,
+# чтобы клики по админке не ходили каждый раз в users
+_admin_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+
+async def is_admin_tg(tg_id: int, session: AsyncSession | None = None) -> bool:
+    flag = _admin_cache.get(tg_id)
+    if flag is None:
+        if session is None:
+            async with async_session() as session:
+                flag = bool((await session.execute(_STMT_IS_ADMIN, {"tg_id": tg_id})).scalar_one_or_none())
+        else:
+            flag = bool((await session.execute(_STMT_IS_ADMIN, {"tg_id": tg_id})).scalar_one_or_none())
+        _admin_cache[tg_id] = flag
+    return flag
+
+async def require_admin(update, session=None) -> bool:
+    return await is_admin_tg(update.effective_user.id, session)
 
 async def build_user_card(uid: int, show_devices: bool):
     async with async_session() as session:
-        u = await get_user_by_id(session, uid)
-        if not u:
-            return "Пользователь не найден.", InlineKeyboardMarkup([back_to_admin()])
-
-        now = datetime.now(timezone.utc)
-        total_quota = max(0, int(u.total_quota() or 0))
+        row = (await session.execute(_STMT_USER_CARD, {"uid": uid})).first()
+        if not row:
+            return "Пользователь не найден.", KB_BACK_ADMIN_ONLY
+        u, used = row[0], row.used_count or 0
 
-        used = (await session.execute(
-            select(func.count(Device.id)).where(Device.user_id == u.id)
-        )).scalar_one() or 0
+        now = utcnow()
+        total_quota = max(0, int(u.total_quota(now) or 0))
 
         free = max(0, total_quota - int(used))
 
@@ -461,24 +766,31 @@ async def render_user_card_message(chat_id: int, u: User, update: Update, contex
 
 from telegram.constants import ParseMode
 
+# состояние мастера рассылки: один слот в user_data, снимается целиком
+@dataclass(slots=True)
+class NotifyState:
+    scope: str  # active | inactive | all
+    text: Optional[str] = None  # итоговый текст с шапкой, после предпросмотра
+    awaiting: bool = True  # ждём текст уведомления
+
+NOTIFY_KEY = "notify"
+
 async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.effective_message
     text_in = (msg.text or "").strip()
 
     # 1) ждём текст для рассылки?
-    if context.user_data.get("await_notify_text"):
+    notify = context.user_data.get(NOTIFY_KEY)
+    if notify is not None and notify.awaiting:
         if not text_in:
             await msg.reply_text("Сообщение пустое. Отправьте текст уведомления.")
             return
 
-        scope = context.user_data.get("notify_scope")
-        if not scope:
-            await msg.reply_text("Не выбрана аудитория. Откройте: 📣 Уведомления.")
-            context.user_data.pop("await_notify_text", None)
-            return
-
-        # Сохраняем текст и показываем предпросмотр
-        context.user_data["notify_text"] = text_in
+        scope = notify.scope
+        # Сохраняем итоговый текст (с шапкой) — он же уйдёт всем получателям без пересборки
+        full_text = notify.text = BOT_BROADCAST_HEADER + text_in
+        # текст зафиксирован: следующее сообщение админа не подменит то, что показано в предпросмотре
+        notify.awaiting = False
         scope_h = (
             "активным пользователям" if scope == "active"
             else "неактивным пользователям" if scope == "inactive"
@@ -487,14 +799,9 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         preview = (
             "👀 *Предпросмотр*\n\n"
             f"Будет отправлено *{scope_h}*.\n\n"
-            f"{BOT_BROADCAST_HEADER}{text_in}"
+            f"{full_text}"
         )
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✅ Отправить", callback_data="admin:notify:confirm:send")],
-            [InlineKeyboardButton("❌ Отмена",    callback_data="admin:notify:confirm:cancel")],
-            [InlineKeyboardButton("⬅️ Назад",     callback_data="admin:notify")]
-        ])
-        await msg.reply_text(preview, reply_markup=kb, parse_mode=ParseMode.MARKDOWN)
+        await msg.reply_text(preview, reply_markup=NOTIFY_PREVIEW_MARKUP, parse_mode=ParseMode.MARKDOWN)
         return
 
     # 2) иначе — строгий поиск пользователя (@username или ID)
@@ -510,8 +817,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         async with async_session() as session:
-            me = (await session.execute(select(User).where(User.tg_id == update.effective_user.id))).scalar_one_or_none()
-            if not me or not me.is_admin:
+            if not await is_admin_tg(update.effective_user.id, session):
                 await msg.reply_text("❌ Недостаточно прав.")
                 return
 
@@ -531,7 +837,6 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["await_user_search_exact"] = False
         return
 
-from typing import Optional, List, Tuple
 async def ensure_user(
     session: AsyncSession,
     tg_id: int,
@@ -544,8 +849,8 @@ async def ensure_user(
     Создаёт пользователя при первом заходе. Возвращает (user, notices),
     где notices — список уведомлений [(chat_id, text), ...] для рассылки.
 
-    Логика:
-    - Если пользователь уже существует:
+    Логика (вставка/поиск — одним INSERT ... ON CONFLICT (tg_id), без гонки двух /start):
+    - Если пользователь уже существует (username обновляется на актуальный):
         * Если он пришёл со ссылкой (ref_code указан), отправим ему вежливое сообщение,
           что рефералка работает только для новых пользователей.
         * Никаких бонусов не начисляем.
@@ -560,17 +865,25 @@ async def ensure_user(
     """
     notices: List[Tuple[int, str]] = []
 
-    # 1) Ищем пользователя
-    res = await session.execute(select(User).where(User.tg_id == tg_id))
-    user = res.scalar_one_or_none()
+    # 1) Создаём или находим пользователя; xmax = 0 только у только что вставленной строки
+    ins = pg_insert(User).values(
+        tg_id=tg_id,
+        username=username,
+        first_name=first,
+        last_name=last,
+        is_admin=(tg_id in settings.admin_ids),
+        referral_code=gen_ref_code(),
+    )
+    user, inserted = (await session.execute(
+        ins.on_conflict_do_update(index_elements=[User.tg_id], set_={"username": ins.excluded.username})
+        .returning(User, literal_column("xmax = 0").label("inserted")),
+        execution_options={"populate_existing": True},
+    )).one()
 
     # --- УЖЕ СУЩЕСТВУЕТ ---
-    if user is not None:
+    if not inserted:
         # пришёл по реф-коду, но он уже есть в системе
         if ref_code:
-            # Найдём владельца кода (чисто для корректности, но бонусов не будет)
-            r = await session.execute(select(User).where(User.referral_code == ref_code))
-            owner = r.scalar_one_or_none()
             # Сообщим пользователю, что рефералка только для новых аккаунтов
             # (не важно, чей код — просто вежливо уведомим)
             notices.append((
@@ -581,38 +894,34 @@ async def ensure_user(
                     "Но вы уже с нами — спасибо! 😊"
                 )
             ))
+        await session.commit()  # фиксируем обновлённый username
         return user, notices
 
     # --- НОВЫЙ ПОЛЬЗОВАТЕЛЬ ---
-    user = User(
-        tg_id=tg_id,
-        username=username,
-        first_name=first,
-        last_name=last,
-        is_admin=(tg_id in settings.admin_ids),
-        referral_code=gen_ref_code(),
-    )
-    session.add(user)
-    await session.flush()  # нужен user.id
-
     ref_owner = None
     if ref_code:
-        r = await session.execute(select(User).where(User.referral_code == ref_code))
-        ref_owner = r.scalar_one_or_none()
         # Защита от self-ref: если код его же, не применять рефералку
-        if ref_owner and ref_owner.id == user.id:
-            ref_owner = None
+        owner_cond = and_(User.referral_code == ref_code, User.id != user.id)
+        if REF_REFERRER_FIXED > 0:
+            # находим владельца кода и начисляем ему фикс одним UPDATE ... RETURNING
+            ref_owner = (await session.execute(
+                update(User).where(owner_cond)
+                .values(balance=User.balance + REF_REFERRER_FIXED)
+                .returning(User.id, User.tg_id)
+            )).one_or_none()
+        else:
+            ref_owner = (await session.execute(
+                select(User.id, User.tg_id).where(owner_cond)
+            )).one_or_none()
 
     # Если есть валидный владелец кода — применяем бонусы
     if ref_owner:
         # 1) Пробный период другу
-        trial_days = int(getattr(settings, "ref_trial_days", 0) or 0)
+        trial_days = settings.ref_trial_days
         if trial_days > 0:
-            now = datetime.now(timezone.utc)
-            base_from = user.subscription_until or now
-            if base_from < now:
-                base_from = now
-            user.subscription_until = base_from + timedelta(days=trial_days)
+            user.subscription_until = _extend_from(
+                user.subscription_until, trial_days * DAY, utcnow()
+            )
             # минимум 1 базовый слот на время триала
             if (user.device_quota or 0) < 1:
                 user.device_quota = 1
@@ -630,15 +939,8 @@ async def ensure_user(
                 )
             ))
 
-        # 2) Фикс на баланс рефереру
-        ref_fix = getattr(settings, "ref_referrer_fixed_rub", 0) or 0
-        try:
-            ref_fix_dec = Decimal(ref_fix)
-        except Exception:
-            ref_fix_dec = Decimal(0)
-        if ref_fix_dec > 0:
-            # аккуратно суммируем Decimal
-            ref_owner.balance = (Decimal(ref_owner.balance) + ref_fix_dec)
+        # 2) Фикс на баланс рефереру (уже начислен выше)
+        if REF_REFERRER_FIXED > 0:
             # красивое имя пришедшего
             who = f"@{username}" if username else (first or "пользователь")
             # Уведомление рефереру
@@ -647,7 +949,7 @@ async def ensure_user(
                 (
                     "💸 Реферальное начисление\n"
                     f"По вашей ссылке зарегистрировался {who}.\n"
-                    f"Начислено на баланс: {int(ref_fix_dec)} ₽.\n"
+                    f"Начислено на баланс: {int(REF_REFERRER_FIXED)} ₽.\n"
                     "Спасибо, что делитесь сервисом! 🙌"
                 )
             ))
@@ -662,63 +964,258 @@ async def ensure_user(
 # Menus (static parents)
 # ---------------------------
 
+# Статичные меню собираем один раз: разметка неизменяемая, её можно переиспользовать
+_MAIN_MENU_ROWS = [
+    [InlineKeyboardButton("💰 Подписки", callback_data="menu:tariffs")],
+    [InlineKeyboardButton("🖥 Мои устройства", callback_data="menu:devices")],
+    [InlineKeyboardButton("🔗 Реферальная программа", callback_data="menu:ref")],
+    [InlineKeyboardButton("❓ Помощь", callback_data="menu:help")]
+]
+MAIN_MENU_MARKUP = kb(_MAIN_MENU_ROWS)
+MAIN_MENU_ADMIN_MARKUP = kb(_MAIN_MENU_ROWS + [[InlineKeyboardButton("⚙️ Админ-панель", callback_data="menu:admin")]])
+
 def main_menu(user: User) -> InlineKeyboardMarkup:
-    rows = [
-        [InlineKeyboardButton("💰 Подписки", callback_data="menu:tariffs")],
-        [InlineKeyboardButton("🖥 Мои устройства", callback_data="menu:devices")],
-        [InlineKeyboardButton("🔗 Реферальная программа", callback_data="menu:ref")],
-        [InlineKeyboardButton("❓ Помощь", callback_data="menu:help")]
+    return MAIN_MENU_ADMIN_MARKUP if user.is_admin else MAIN_MENU_MARKUP
+
+BROADCAST_CONCURRENCY = 20
+BROADCAST_RATE = 25  # сообщений в секунду: общий лимит Telegram на бота ~30/с
+BROADCAST_RETRIES = 3  # сколько раз подряд получатель может упереться во флуд-контроль
+
+def _retry_after_s(e: RetryAfter) -> float:
+    # PTB 22 отдаёт int или timedelta — в зависимости от настроек
+    ra = e.retry_after
+    return ra.total_seconds() if isinstance(ra, timedelta) else float(ra)
+
+BROADCAST_QUEUE_SIZE = 1000  # сколько id выборка может опережать отправку
+
+class _SendPacer:
+    """
+    Общий темп отправки для всех рассылок процесса: не больше rate сообщений/с на бота
+    и не чаще раза в секунду в один чат — две рассылки подряд не упираются в 429.
+    """
+    def __init__(self, rate: float) -> None:
+        self._interval = 1.0 / rate
+        self._next = 0.0
+        # чат -> когда в него снова можно писать; старые записи вытесняются сами
+        self._chats: TTLCache = TTLCache(maxsize=100_000, ttl=60)
+
+    async def wait(self, chat_id: int) -> None:
+        # между чтением и записью слотов нет await — гонок внутри event loop нет
+        now = time.monotonic()
+        slot = max(now, self._next)
+        self._next = slot + self._interval
+        slot = max(slot, self._chats.get(chat_id, 0.0))
+        self._chats[chat_id] = slot + 1.0
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+_broadcast_pacer = _SendPacer(BROADCAST_RATE)
+
+async def _send_broadcast_one(send, tg_id: int) -> bool:
+    # send(chat_id) — send_message с готовым текстом или copy_message из канала рассылок
+    try:
+        for _ in range(BROADCAST_RETRIES):
+            await _broadcast_pacer.wait(tg_id)
+            try:
+                await send(tg_id)
+                return True
+            except RetryAfter as e:
+                # флуд-контроль: ждём, сколько просит Telegram, и пробуем снова
+                await asyncio.sleep(_retry_after_s(e))
+        return False
+    except TelegramError:
+        # бот заблокирован, чат удалён и т.п. — считаем как недоставленное
+        return False
+
+async def iter_recipient_ids(scope: str, chunk_size: int = 500):
+    """
+    Отдаёт tg_id получателей пачками по chunk_size.
+    Пачки — keyset-пагинацией по users.id (WHERE id > последний ORDER BY id LIMIT n),
+    каждая в своей короткой сессии: пока рассылка идёт в темпе Telegram (это минуты),
+    соединение и транзакция не держатся — пул свободен, vacuum не блокируется.
+    """
+    now = utcnow()  # одна граница активности на всю рассылку
+    q = select(User.id, User.tg_id).order_by(User.id).limit(chunk_size)
+    if scope == "active":
+        q = q.where(active_clause(now))
+    elif scope == "inactive":
+        q = q.where(inactive_clause(now))
+    last_id = 0
+    while True:
+        async with async_session() as session:
+            rows = (await session.execute(q.where(User.id > last_id))).all()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        yield [r.tg_id for r in rows]
+        if len(rows) < chunk_size:
+            return
+
+async def count_recipients_all(session, with_devices: bool = False) -> tuple[int, ...]:
+    """
+    (все, активные, неактивные) — одним проходом по users через COUNT ... FILTER.
+    with_devices=True добавляет четвёртым числом включённые устройства (для статистики админки).
+    """
+    now = utcnow()
+    # count(*) — без проверки id на NULL в каждой строке
+    cols = [
+        func.count(),
+        func.count().filter(active_clause(now)),
+        func.count().filter(inactive_clause(now)),
     ]
-    if user.is_admin:
-        rows.append([InlineKeyboardButton("⚙️ Админ-панель", callback_data="menu:admin")])
-    return kb(rows)
-
-async def list_recipient_ids(session, scope: str) -> list[int]:
-    now = datetime.now(timezone.utc)
-    if scope == "all":
-        q = select(User.tg_id)
-    elif scope == "active":
-        q = select(User.tg_id).where(active_clause(now))
-    else:  # inactive
-        q = select(User.tg_id).where(~active_clause(now))
-    return [row[0] for row in (await session.execute(q)).all()]
+    if with_devices:
+        cols.append(select(func.count(Device.id)).where(Device.enabled.is_(True)).scalar_subquery())
+    row = (await session.execute(select(*cols).select_from(User))).one()
+    return tuple(row)
 
 async def count_recipients(session, scope: str) -> int:
-    now = datetime.now(timezone.utc)
-    if scope == "all":
-        q = select(func.count(User.id))
-    elif scope == "active":
-        q = select(func.count(User.id)).where(active_clause(now))
-    elif scope == "inactive":
-        q = select(func.count(User.id)).where(~active_clause(now))
-    else:
-        return 0
-    return (await session.execute(q)).scalar_one()
+    all_, active, inactive = await count_recipients_all(session)
+    return {"all": all_, "active": active, "inactive": inactive}.get(scope, 0)
 
 def active_clause(now):
-    return or_(
-        and_(User.subscription_until.is_not(None), User.subscription_until > now),
-        and_(User.extra_devices_until.is_not(None), User.extra_devices_until > now),
-    )
-
-def notify_scope_kb():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🟢 Активным",   callback_data="admin:notify:scope:active")],
-        [InlineKeyboardButton("⚪️ Неактивным", callback_data="admin:notify:scope:inactive")],
-        [InlineKeyboardButton("👥 Всем",       callback_data="admin:notify:scope:all")],
-        back_to_admin()
-    ])
+    # active_until = GREATEST(база, доп. слоты) — сравнение идёт по индексу ix_users_active_until_tg
+    return User.active_until > now
+
+def inactive_clause(now):
+    # NULL — ни разу не было доступа; NOT (NULL > now) дал бы NULL, поэтому явно
+    return or_(User.active_until.is_(None), User.active_until <= now)
+
+NOTIFY_SCOPE_MARKUP = kb([
+    [InlineKeyboardButton("🟢 Активным",   callback_data="admin:notify:scope:active")],
+    [InlineKeyboardButton("⚪️ Неактивным", callback_data="admin:notify:scope:inactive")],
+    [InlineKeyboardButton("👥 Всем",       callback_data="admin:notify:scope:all")],
+    back_to_admin()
+])
+
+def notify_scope_kb() -> InlineKeyboardMarkup:
+    return NOTIFY_SCOPE_MARKUP
+
+ADMIN_MENU_MARKUP = kb([
+    [InlineKeyboardButton("⚙️ Настройки", callback_data="admin:settings")],
+    [InlineKeyboardButton("📣 Уведомления", callback_data="admin:notify")],
+    [InlineKeyboardButton("📊 Статистика", callback_data="admin:stats")],
+    [InlineKeyboardButton("👥 Пользователи", callback_data="admin:users_list")],
+    [InlineKeyboardButton("💳 Платежи", callback_data="admin:payments_list")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="menu:main")],
+])
 
 def admin_menu() -> InlineKeyboardMarkup:
-    rows = [
-        [InlineKeyboardButton("⚙️ Настройки", callback_data="admin:settings")],
-        [InlineKeyboardButton("📣 Уведомления", callback_data="admin:notify")],
-        [InlineKeyboardButton("📊 Статистика", callback_data="admin:stats")],
-        [InlineKeyboardButton("👥 Пользователи", callback_data="admin:users_list")],
-        [InlineKeyboardButton("💳 Платежи", callback_data="admin:payments_list")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="menu:main")],
-    ]
-    return kb(rows)
+    return ADMIN_MENU_MARKUP
+
+ADMIN_USERS_LIST_MARKUP = kb([
+    [InlineKeyboardButton("🔍 Поиск пользователя", callback_data="admin:users")],
+    back_to_admin(),
+])
+ADMIN_PAYMENTS_LIST_MARKUP = kb([
+    [InlineKeyboardButton("💰 Статистика платежей", callback_data="admin:payments")],
+    back_to_admin(),
+])
+NOTIFY_BACK_MARKUP = kb([[InlineKeyboardButton("⬅️ Назад", callback_data="admin:notify")]])
+NOTIFY_PREVIEW_MARKUP = kb([
+    [InlineKeyboardButton("✅ Отправить", callback_data="admin:notify:confirm:send")],
+    [InlineKeyboardButton("❌ Отмена",    callback_data="admin:notify:confirm:cancel")],
+    [InlineKeyboardButton("⬅️ Назад",     callback_data="admin:notify")],
+])
+
+# ---------------------------
+# Help (статичные тексты и клавиатуры)
+# ---------------------------
+
+HELP_MENU_TEXT = (
+    "❓ *Помощь*\n\n"
+    "Добро пожаловать в центр поддержки!\n\n"
+    "Здесь ты найдёшь:\n"
+    "• ответы на частые вопросы,\n"
+    "• инструкции по подключению и настройке,\n"
+    "• информацию о тарифах и устройствах.\n\n"
+    "Выбирай нужный раздел ниже и получай подсказки 👇"
+)
+
+HELP_HOW_TEXT = (
+    "📡 *Как подключить VPN*\n\n"
+    "1) 💰 *Оформи подписку* — выбери подходящий срок и оплати.\n\n"
+    "2) 🖥 *Зайди в «Мои устройства»* — открой раздел в боте.\n\n"
+    "3) ➕ *Нажми «Добавить устройство»* — бот создаст конфиг (1 конфиг = 1 устройство).\n"
+    "   • Если конфиг *пришёл сообщением* — просто скачай его.\n"
+    "   • Если конфиг *не пришёл автоматически* — открой созданное устройство и нажми:\n"
+    "     📥 *Скачать конфиг* — файл *.conf* для импорта\n"
+    "     🗑 *Удалить* — если устройство больше не нужно\n\n"
+    "4) ⚙️ *Установи WireGuard* на своё устройство (iOS/Android/Windows/macOS/Linux).\n\n"
+    "5) 📲 *Импортируй конфиг* в WireGuard:\n"
+    "   • через файл *.conf* (📥 Импорт из файла),\n"
+    "6) 🔌 *Включи туннель* в WireGuard — готово! Интернет пойдёт через VPN.\n\n"
+    "ℹ️ Подсказки:\n"
+    "• Подписка даёт базовый лимит устройств; доп. устройства покупаются отдельно.\n"
+    "• Нужно освободить слот? Удали лишний конфиг и создай новый.\n"
+    "• Что-то не работает — смотри раздел «🧰 VPN не работает»."
+)
+
+HELP_TROUBLESHOOT_TEXT = (
+    "🧰 *VPN не работает*\n\n"
+    "Действуем по шагам — обычно этого достаточно:\n\n"
+    "1) 🔐 *Проверь подписку.* Если она не активна, доступ к VPN закрыт.\n"
+    "2) 📄 *Обнови конфиг.* Зайди в *🖥 Мои устройства* → выбери устройство → "
+    "нажми 📥 *Скачать конфиг* (или 🗑 *Удалить* и ➕ *Добавить устройство* заново).\n"
+    "3) 🔁 *Перезапусти VPN и устройство.* Выключи/включи профиль в приложении WireGuard, "
+    "затем перезагрузи телефон/компьютер.\n\n"
+    "🚫 *Не подключается*\n"
+    "• 🌍 Попробуй *другую сеть*: мобильный интернет вместо Wi-Fi или наоборот — "
+    "иногда сеть блокирует VPN.\n"
+    "• ⏱ Убедись, что на устройстве *включено авто-время и авто-часовой пояс* — "
+    "сбитые часы мешают соединению.\n"
+    "• 📴 Отключи другие VPN/прокси/блокировщики трафика, если они включены.\n\n"
+    "🐢 *Медленно или обрывы*\n"
+    "• Переключись между Wi-Fi и мобильной сетью, закрой тяжёлые загрузки и попробуй ещё раз.\n\n"
+    "Если проблема осталась — напиши нам в поддержку, мы быстро поможем 💬"
+)
+
+HELP_DEVICES_TEXT = (
+    "📱 *Устройства и лимиты*\n\n"
+    "• Лимит «включённых в подписку» устройств зависит от тарифа (1/2/3/5).\n"
+    "• Каждый конфиг = 1 устройство.\n"
+    "• Конфиги из подписки можно удалять и перевыпускать.\n"
+    "• Если *основная подписка заканчивается*, то *все устройства, выданные по подписке, удаляются*.\n"
+    "• *Доп. устройства* (купленные отдельно) при этом продолжают работать *до окончания их оплаченного срока*.\n"
+    "• Купить новые доп. устройства *нельзя*, если подписка не активна."
+)
+
+HELP_ADDONS_TEXT = (
+    "➕ *Доп. устройства*\n\n"
+    "• Стоимость: *100 ₽/мес* за 1 устройство.\n"
+    "• Купить можно *только при активной* основной подписке.\n"
+    "• Все доп. устройства синхронизированы по сроку: первая покупка задаёт «якорь»,\n"
+    "  и *все* последующие допы закончатся в *один день* — через ~1 месяц от якоря.\n"
+    "• Если основная подписка закончилась, уже купленные доп. устройства *продолжают работать*\n"
+    "  до конца своего оплаченного срока, затем *удаляются*.\n"
+    "• Пока подписка не активна, *докупать* доп. устройства нельзя."
+)
+
+SUPPORT_HANDLE = "@AraTop4k"
+HELP_SUPPORT_TEXT = (
+    "💬 *Чат поддержки*\n\n"
+    "Нужна помощь или остались вопросы? Мы рядом и ответим максимально быстро.\n\n"
+    "👤 *Кому писать:* {handle}\n"
+    "✍️ *Что указать в первом сообщении:*\n"
+    "• ваш тариф (7/30/90/365)\n"
+    "• коротко проблему/вопрос\n"
+    "• при необходимости — скрин/ошибку\n\n"
+    "Нажмите кнопку ниже, чтобы открыть чат и написать нам прямо сейчас."
+).format(handle=SUPPORT_HANDLE)
+
+HELP_MENU_KB = kb([
+    [InlineKeyboardButton("📡 Как подключить VPN", callback_data="help:how")],
+    [InlineKeyboardButton("🧰 VPN не работает", callback_data="help:troubleshoot")],
+    [InlineKeyboardButton("📱 Устройства и лимиты", callback_data="help:devices")],
+    [InlineKeyboardButton("➕ Доп. устройства", callback_data="help:addons")],
+    [InlineKeyboardButton("💬 Чат поддержки", callback_data="help:support")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="menu:main")]
+])
+# у разделов how/troubleshoot/devices/addons одна и та же кнопка «Назад»
+HELP_BACK_KB = kb([[InlineKeyboardButton("⬅️ Назад", callback_data="menu:help")]])
+HELP_SUPPORT_KB = kb([
+    [InlineKeyboardButton("🗨️ Открыть чат", url="https://t.me/AraTop4k")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="menu:help")]
+])
 
 # ---------------------------
 # Commands
@@ -730,21 +1227,18 @@ async def _render_main_menu(query_or_message, tg_user):
     """
     # 1) Берём пользователя и считаем использованные устройства
     async with async_session() as session:
-        u = (await session.execute(
-            select(User).where(User.tg_id == tg_user.id)
-        )).scalar_one()
-
-        used = (await session.execute(
-            select(func.count(Device.id)).where(Device.user_id == u.id)
-        )).scalar_one()
+        u = (await session.execute(_STMT_USER_MENU, {"tg_id": tg_user.id})).one()
+    used = u.used_count
 
     # 2) Квоты
-    base_q = int(u.device_quota or 0) if _has_base(u) else 0
-    extra_q = int(getattr(u, "extra_devices_count", 0) or 0) if _has_extra(u) else 0
+    now = utcnow()
+    base_active = _has_base(u, now)
+    base_q = int(u.device_quota or 0) if base_active else 0
+    extra_q = int(getattr(u, "extra_devices_count", 0) or 0) if _has_extra(u, now) else 0
     total_q = max(0, base_q + extra_q)
 
     # 3) Статусы
-    sub_line = f"✅ Активна (до {fmt_human(u.subscription_until)})" if _has_base(u) else "❌ Нет активной подписки"
+    sub_line = f"✅ Активна (до {fmt_human(u.subscription_until)})" if base_active else "❌ Нет активной подписки"
     extra_line = (
         f"💳 Платные устройства: {extra_q} (до {fmt_human(getattr(u, 'extra_devices_until', None))})"
         if extra_q > 0 else
@@ -787,21 +1281,20 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ref_code=ref,
         )
 
-    # разошлём уведомления (если есть)
-    for chat_id, text in notices:
-        try:
-            await context.bot.send_message(chat_id=chat_id, text=text, disable_web_page_preview=True)
-        except Exception as e:
-            print(f"[referral notice] failed to send to {chat_id}: {e}")
+    # разошлём уведомления (если есть) — их максимум два, шлём параллельно
+    results = await asyncio.gather(
+        *(context.bot.send_message(chat_id=chat_id, text=text, disable_web_page_preview=True) for chat_id, text in notices),
+        return_exceptions=True,
+    )
+    for (chat_id, _), r in zip(notices, results):
+        if isinstance(r, Exception):
+            log.warning("referral notice to %s failed: %s", chat_id, r)
 
     # рендер главного меню как раньше
     await _render_main_menu(update.effective_message, update.effective_user)
 
 async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    async with async_session() as session:
-        res = await session.execute(select(User).where(User.tg_id == update.effective_user.id))
-        user = res.scalar_one_or_none()
-    if not user or not user.is_admin:
+    if not await is_admin_tg(update.effective_user.id):
         await update.effective_message.reply_text("Недостаточно прав.")
         return
     await update.effective_message.reply_text("Админ-панель", reply_markup=admin_menu())
@@ -810,243 +1303,103 @@ async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Callbacks (hard tree)
 # ---------------------------
 
-async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    data = query.data or ""
-
-    # ---- help ----
-    if data == "menu:help":
-        text = (
-            "❓ *Помощь*\n\n"
-            "Добро пожаловать в центр поддержки!\n\n"
-            "Здесь ты найдёшь:\n"
-            "• ответы на частые вопросы,\n"
-            "• инструкции по подключению и настройке,\n"
-            "• информацию о тарифах и устройствах.\n\n"
-            "Выбирай нужный раздел ниже и получай подсказки 👇"
-        )
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("📡 Как подключить VPN", callback_data="help:how")],
-            [InlineKeyboardButton("🧰 VPN не работает", callback_data="help:troubleshoot")],
-            [InlineKeyboardButton("📱 Устройства и лимиты", callback_data="help:devices")],
-            [InlineKeyboardButton("➕ Доп. устройства", callback_data="help:addons")],
-            [InlineKeyboardButton("💬 Чат поддержки", callback_data="help:support")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="menu:main")]
-        ]), parse_mode="Markdown")
-        return
+# query.id, на которые хендлер уже ответил alert'ом — on_callback тогда не шлёт пустой ответ
+_alerted: set[str] = set()
 
-    if data == "help:how":
-        text = (
-            "📡 *Как подключить VPN*\n\n"
-            "1) 💰 *Оформи подписку* — выбери подходящий срок и оплати.\n\n"
-            "2) 🖥 *Зайди в «Мои устройства»* — открой раздел в боте.\n\n"
-            "3) ➕ *Нажми «Добавить устройство»* — бот создаст конфиг (1 конфиг = 1 устройство).\n"
-            "   • Если конфиг *пришёл сообщением* — просто скачай его.\n"
-            "   • Если конфиг *не пришёл автоматически* — открой созданное устройство и нажми:\n"
-            "     📥 *Скачать конфиг* — файл *.conf* для импорта\n"
-            "     🗑 *Удалить* — если устройство больше не нужно\n\n"
-            "4) ⚙️ *Установи WireGuard* на своё устройство (iOS/Android/Windows/macOS/Linux).\n\n"
-            "5) 📲 *Импортируй конфиг* в WireGuard:\n"
-            "   • через файл *.conf* (📥 Импорт из файла),\n"
-            "6) 🔌 *Включи туннель* в WireGuard — готово! Интернет пойдёт через VPN.\n\n"
-            "ℹ️ Подсказки:\n"
-            "• Подписка даёт базовый лимит устройств; доп. устройства покупаются отдельно.\n"
-            "• Нужно освободить слот? Удали лишний конфиг и создай новый.\n"
-            "• Что-то не работает — смотри раздел «🧰 VPN не работает»."
-        )
-        await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("⬅️ Назад", callback_data="menu:help")]]
-            ),
-            parse_mode="Markdown"
-        )
-        return
+async def _alert(query, text: str) -> None:
+    _alerted.add(query.id)
+    await query.answer(text, show_alert=True)
 
-    if data == "help:troubleshoot":
-        text = (
-            "🧰 *VPN не работает*\n\n"
-            "Действуем по шагам — обычно этого достаточно:\n\n"
-            "1) 🔐 *Проверь подписку.* Если она не активна, доступ к VPN закрыт.\n"
-            "2) 📄 *Обнови конфиг.* Зайди в *🖥 Мои устройства* → выбери устройство → "
-            "нажми 📥 *Скачать конфиг* (или 🗑 *Удалить* и ➕ *Добавить устройство* заново).\n"
-            "3) 🔁 *Перезапусти VPN и устройство.* Выключи/включи профиль в приложении WireGuard, "
-            "затем перезагрузи телефон/компьютер.\n\n"
-            "🚫 *Не подключается*\n"
-            "• 🌍 Попробуй *другую сеть*: мобильный интернет вместо Wi-Fi или наоборот — "
-            "иногда сеть блокирует VPN.\n"
-            "• ⏱ Убедись, что на устройстве *включено авто-время и авто-часовой пояс* — "
-            "сбитые часы мешают соединению.\n"
-            "• 📴 Отключи другие VPN/прокси/блокировщики трафика, если они включены.\n\n"
-            "🐢 *Медленно или обрывы*\n"
-            "• Переключись между Wi-Fi и мобильной сетью, закрой тяжёлые загрузки и попробуй ещё раз.\n\n"
-            "Если проблема осталась — напиши нам в поддержку, мы быстро поможем 💬"
-        )
-        await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("⬅️ Назад", callback_data="menu:help")]]
-            ),
-            parse_mode="Markdown"
-        )
-        return
+async def _cb_unknown(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    await query.edit_message_text("Неизвестное действие.", reply_markup=KB_BACK_MAIN_ONLY)
 
-    if data == "help:devices":
-        text = (
-            "📱 *Устройства и лимиты*\n\n"
-            "• Лимит «включённых в подписку» устройств зависит от тарифа (1/2/3/5).\n"
-            "• Каждый конфиг = 1 устройство.\n"
-            "• Конфиги из подписки можно удалять и перевыпускать.\n"
-            "• Если *основная подписка заканчивается*, то *все устройства, выданные по подписке, удаляются*.\n"
-            "• *Доп. устройства* (купленные отдельно) при этом продолжают работать *до окончания их оплаченного срока*.\n"
-            "• Купить новые доп. устройства *нельзя*, если подписка не активна."
-        )
-        await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("⬅️ Назад", callback_data="menu:help")]]
-            ),
-            parse_mode="Markdown"
-        )
-        return
+async def _send_wg_config(context: ContextTypes.DEFAULT_TYPE, chat_id: int, d: M.Device) -> None:
+    """Забирает .conf устройства из WG-Easy и шлёт файлом. Ошибки WG/Telegram — вызывающему."""
+    cfg = await get_wg_client().get_config(d.wg_client_id)
+    await context.bot.send_document(chat_id=chat_id, document=InputFile(cfg, filename=f"{d.wg_client_name}.conf"))
 
-    if data == "help:addons":
-        text = (
-            "➕ *Доп. устройства*\n\n"
-            "• Стоимость: *100 ₽/мес* за 1 устройство.\n"
-            "• Купить можно *только при активной* основной подписке.\n"
-            "• Все доп. устройства синхронизированы по сроку: первая покупка задаёт «якорь»,\n"
-            "  и *все* последующие допы закончатся в *один день* — через ~1 месяц от якоря.\n"
-            "• Если основная подписка закончилась, уже купленные доп. устройства *продолжают работать*\n"
-            "  до конца своего оплаченного срока, затем *удаляются*.\n"
-            "• Пока подписка не активна, *докупать* доп. устройства нельзя."
-        )
-        await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("⬅️ Назад", callback_data="menu:help")]]
-            ),
-            parse_mode="Markdown"
+async def _render_devices_menu(query, user_id: int):
+    # 1) Достаём пользователя и его устройства
+    async with async_session() as session:
+        res = (await session.execute(_STMT_USER_WITH_DEVICES, {"tg_id": user_id})).all()
+    if not res:
+        raise NoResultFound("user not found")
+    u = res[0][0]
+    # устройства уже отсортированы по дате создания в запросе
+    devices = [d for _, d in res if d is not None]
+
+    # 2) Считаем квоты и использованные слоты
+    base_q = _base_quota(u)
+    extra_q = _extra_quota(u)
+    total_q = base_q + extra_q
+
+    used_total = len(devices)
+    used_base = min(used_total, base_q)
+    used_paid = max(0, used_total - used_base)
+
+    # 3) Текстовая шапка без подписок — только про устройства
+    if used_total == 0:
+        header = (
+            "🖥 Устройства\n\n"
+            f"🆓 Бесплатные занято: 0/{base_q}\n"
+            f"💳 Платные занято: 0/{extra_q}\n"
+            f"📈 Всего: 0/{total_q}\n\n"
+            "Пока устройств нет."
         )
-        return
-
-    if data == "help:support":
-        handle = "@AraTop4k"
-        text = (
-            "💬 *Чат поддержки*\n\n"
-            "Нужна помощь или остались вопросы? Мы рядом и ответим максимально быстро.\n\n"
-            "👤 *Кому писать:* {handle}\n"
-            "✍️ *Что указать в первом сообщении:*\n"
-            "• ваш тариф (7/30/90/365)\n"
-            "• коротко проблему/вопрос\n"
-            "• при необходимости — скрин/ошибку\n\n"
-            "Нажмите кнопку ниже, чтобы открыть чат и написать нам прямо сейчас."
-        ).format(handle=handle)
-
-        await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🗨️ Открыть чат", url="https://t.me/AraTop4k")],
-                [InlineKeyboardButton("⬅️ Назад", callback_data="menu:help")]
-            ])
+    else:
+        header = (
+            "🖥 Устройства\n\n"
+            f"🆓 Бесплатные занято: {used_base}/{base_q}\n"
+            f"💳 Платные занято: {used_paid}/{extra_q}\n"
+            f"📈 Всего: {used_total}/{total_q}"
         )
-        return
 
-    # ---- MAIN ----
-    if data == "menu:main":
-        await _render_main_menu(update.callback_query, update.effective_user)
-        return
-
-    # ---- TARIFFS ----
+    # 4) Кнопки устройств — каждую явно помечаем: всё, что выходит за базовую квоту, — платное
+    rows: list[list[InlineKeyboardButton]] = [
+        [InlineKeyboardButton(f"{'💳' if idx > base_q else '🆓'} {d.wg_client_name}", callback_data=f"device:view:{d.id}")]
+        for idx, d in enumerate(devices, start=1)
+    ]
 
-    if data.startswith("menu:tariffs"):
-        async with async_session() as session:
-            res = await session.execute(
-                select(Tariff).where(Tariff.is_active == True).order_by(Tariff.days)
-            )
-            tariffs = res.scalars().all()
+    # 5) Действия
+    rows.append([InlineKeyboardButton("➕ Добавить устройство", callback_data="device:add")])
+    rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="menu:main")])
 
-        rows = [[InlineKeyboardButton(
-                    f"{t.name} — {rub(t.price)} ({t.max_devices} устр.)",
-                    callback_data=f"tariff:buy:{t.id}"
-                )] for t in tariffs]
-        rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="menu:main")])
+    await query.edit_message_text(header, reply_markup=InlineKeyboardMarkup(rows))
 
-        await query.edit_message_text("🛒 Выберите тариф:", reply_markup=InlineKeyboardMarkup(rows))
-        return
+# ---- help ----
+async def _cb_menu_help(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    await query.edit_message_text(HELP_MENU_TEXT, reply_markup=HELP_MENU_KB, parse_mode="Markdown")
 
-    if data.startswith("tariff:buy:"):
-        _, _, sid = data.split(":")
-        tariff_id = int(sid)
+async def _cb_help_how(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    await query.edit_message_text(HELP_HOW_TEXT, reply_markup=HELP_BACK_KB, parse_mode="Markdown")
 
-        async with async_session() as session:
-            t = await session.get(Tariff, tariff_id)
-            if not t or not t.is_active:
-                await query.edit_message_text("❌ Тариф не найден или отключён.", reply_markup=InlineKeyboardMarkup([back_to_main()]))
-                return
+async def _cb_help_troubleshoot(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    await query.edit_message_text(HELP_TROUBLESHOOT_TEXT, reply_markup=HELP_BACK_KB, parse_mode="Markdown")
 
-            u = (await session.execute(select(User).where(User.tg_id == update.effective_user.id))).scalar_one()
+async def _cb_help_devices(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    await query.edit_message_text(HELP_DEVICES_TEXT, reply_markup=HELP_BACK_KB, parse_mode="Markdown")
 
-            # Проверка активной подписки
-            from datetime import datetime, timezone
-            now = datetime.now(timezone.utc)
-            if u.subscription_until and u.subscription_until > now:
-                until = fmt_human(u.subscription_until)
-                await query.edit_message_text(
-                    f"❌ У вас уже есть активная подписка до {until}.\n💰 Покупка новой подписки доступна после окончания текущей.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="menu:tariffs")]]),
-                )
-                return
+async def _cb_help_addons(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    await query.edit_message_text(HELP_ADDONS_TEXT, reply_markup=HELP_BACK_KB, parse_mode="Markdown")
 
-            try:
-                pay = await yk_client.create_payment(
-                    float(t.price),
-                    settings.currency,
-                    f"Оплата тарифа {t.name} ({t.days} дней)",
-                    settings.yk_return_url,
-                    metadata={"tg_id": update.effective_user.id, "purpose": "TARIFF", "tariff_id": t.id},
-                )
-            except Exception as e:
-                await query.edit_message_text(
-                    f"❌ Не удалось создать платёж: {e}",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="menu:tariffs")], back_to_main()]),
-                )
-                return
+async def _cb_help_support(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    await query.edit_message_text(HELP_SUPPORT_TEXT, reply_markup=HELP_SUPPORT_KB)
 
-            confirmation_url = (pay.get("confirmation") or {}).get("confirmation_url")
-            if not confirmation_url:
-                await query.edit_message_text(
-                    "❌ Платёж создан, но платёжная ссылка не пришла. Попробуйте ещё раз позже.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="menu:tariffs")], back_to_main()]),
-                )
-                return
+# ---- MAIN ----
+async def _cb_menu_main(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    await _render_main_menu(update.callback_query, update.effective_user)
 
-            # Создаем платеж в БД
-            p = Payment(
-                yk_payment_id=pay["id"],
-                user_id=u.id,
-                status=pay.get("status", "pending"),
-                purpose="TARIFF",
-                amount=float(t.price),
-                currency=settings.currency,
-                tariff_id=t.id,
-                confirmation_url=confirmation_url,
-                meta=pay.get("metadata") or {},
-            )
-            session.add(p)
-            await session.commit()
+# ---- TARIFFS ----
+async def _cb_menu_tariffs(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    await query.edit_message_text("🛒 Выберите тариф:", reply_markup=await tariffs_markup())
 
-            from datetime import datetime, timedelta
-            end_date = datetime.now() + timedelta(days=t.days)
-            formatted_date = end_date.strftime("%d.%m.%Y")
-            # Красивый чек-лист
-            check_list_text = f"""
+# чек-лист заказа: статичный текст, на клик подставляются только поля
+ORDER_TEMPLATE = """
 🎯 ДЕТАЛИ ВАШЕГО ЗАКАЗА
 
-✨ Тариф: {t.name}
-⏳ Срок действия: {t.days} дней (до {formatted_date})
-📱 Устройства: до {t.max_devices} шт.
+✨ Тариф: {name}
+⏳ Срок действия: {days} дней (до {formatted_date})
+📱 Устройства: до {max_devices} шт.
 
 💎 Преимущества тарифа:
 • 🚀 Высокоскоростные VPN-серверы
@@ -1056,7 +1409,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • 🚫 Блокировка рекламы и трекеров
 • 🆘 Круглосуточная поддержка
 
-💰 Стоимость: {rub(t.price)}
+💰 Стоимость: {price}
 ⏰ Счет действителен: 10 минут
 
 📝 Условия:
@@ -1068,847 +1421,883 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 💫 Спасибо, что выбираете нас!
 """
 
-            # Кнопки
-            rows = []
-            rows.append([InlineKeyboardButton("💳 Оплатить картой", url=confirmation_url)])
-            
-            if float(u.balance) >= t.price:
-                rows.append([InlineKeyboardButton("💳 Оплатить балансом", callback_data=f"paybalance:TARIFF:{t.id}")])
-            
-            rows.append([InlineKeyboardButton("⬅️ К тарифам", callback_data="menu:tariffs")])
-            rows.append([InlineKeyboardButton("🏠 Главное меню", callback_data="menu:main")])
-
-            if u.id in user_payment_tasks:
-                old_task = user_payment_tasks[u.id]
-                old_task.cancel()  # Отменяем старую задачу
-                try:
-                    await old_task  # Ждем завершения
-                except asyncio.CancelledError:
-                    print(f"⏹️ Предыдущая задача для user {u.id} отменена")
-                except Exception as e:
-                    print(f"⚠️ Ошибка при отмене предыдущей задачи: {e}")
-            # Запускаем проверку платежа
-            user_payment_tasks[u.id] = asyncio.create_task(auto_check_payment(query, pay["id"], u.id, yk_client))
-
-            await query.edit_message_text(
-                check_list_text,
-                reply_markup=InlineKeyboardMarkup(rows),
-                parse_mode="Markdown"
-            )
-            return
-
-    async def _render_devices_menu(query, user_id: int):
-        # 1) Достаём пользователя и его устройства
-        async with async_session() as session:
-            u = (await session.execute(
-                select(M.User).where(M.User.tg_id == user_id)
-            )).scalar_one()
-
-            res = await session.execute(
-                select(M.Device).where(M.Device.user_id == u.id)
-            )
-            devices = list(res.scalars().all())
-
-        # 2) Считаем квоты и использованные слоты
-        base_q = _base_quota(u)
-        extra_q = _extra_quota(u)
-        total_q = base_q + extra_q
-
-        # стабильный порядок — по дате создания
-        devices.sort(key=lambda d: d.created_at or datetime.min.replace(tzinfo=timezone.utc))
-
-        used_total = len(devices)
-        used_base = min(used_total, base_q)
-        used_paid = max(0, used_total - used_base)
-
-        # 3) Текстовая шапка без подписок — только про устройства
-        if used_total == 0:
-            header = (
-                "🖥 Устройства\n\n"
-                f"🆓 Бесплатные занято: 0/{base_q}\n"
-                f"💳 Платные занято: 0/{extra_q}\n"
-                f"📈 Всего: 0/{total_q}\n\n"
-                "Пока устройств нет."
-            )
-        else:
-            header = (
-                "🖥 Устройства\n\n"
-                f"🆓 Бесплатные занято: {used_base}/{base_q}\n"
-                f"💳 Платные занято: {used_paid}/{extra_q}\n"
-                f"📈 Всего: {used_total}/{total_q}"
-            )
+async def _cb_tariff_buy(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    _, _, sid = data.split(":")
+    tariff_id = int(sid)
 
-        # 4) Кнопки устройств — каждую явно помечаем
-        rows: list[list[InlineKeyboardButton]] = []
-        for idx, d in enumerate(devices, start=1):
-            is_paid = idx > base_q  # всё, что выходит за базовую квоту — платное
-            icon = "💳" if is_paid else "🆓"
-            title = f"{icon} {d.wg_client_name}"
-            rows.append([InlineKeyboardButton(title, callback_data=f"device:view:{d.id}")])
+    t = await get_active_tariff(tariff_id)
+    if not t:
+        await query.edit_message_text("❌ Тариф не найден или отключён.", reply_markup=KB_BACK_MAIN_ONLY)
+        return
 
-        # 5) Действия
-        rows.append([InlineKeyboardButton("➕ Добавить устройство", callback_data="device:add")])
-        rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="menu:main")])
+    # чтение пользователя — одним fetchrow из asyncpg-пула, без ORM-сессии и BEGIN/COMMIT;
+    # соединение не держим, пока ждём YooKassa. ORM-сессия открывается один раз — под INSERT платежа
+    u = await fetch_user(update.effective_user.id)
+    if u is None:
+        raise NoResultFound("user not found")
 
-        await query.edit_message_text(header, reply_markup=InlineKeyboardMarkup(rows))
+    # Проверка активной подписки
+    now = utcnow()
+    if u["subscription_until"] and u["subscription_until"] > now:
+        until = fmt_human(u["subscription_until"])
+        await query.edit_message_text(
+            f"❌ У вас уже есть активная подписка до {until}.\n💰 Покупка новой подписки доступна после окончания текущей.",
+            reply_markup=KB_BACK_TO_TARIFFS_ONLY,
+        )
+        return
 
+    try:
+        pay, is_new = await get_or_create_payment(u["id"], "TARIFF", t.id, t.price, lambda: _get_yk_client().create_payment(
+            float(t.price),
+            settings.currency,
+            f"Оплата тарифа {t.name} ({t.days} дней)",
+            settings.yk_return_url,
+            metadata={"tg_id": update.effective_user.id, "purpose": "TARIFF", "tariff_id": t.id},
+        ))
+    except Exception as e:
+        await query.edit_message_text(
+            f"❌ Не удалось создать платёж: {e}",
+            reply_markup=KB_BACK_TO_TARIFFS,
+        )
+        return
 
-    if data == "menu:devices":
-        await _render_devices_menu(query, update.effective_user.id)
+    confirmation_url = (pay.get("confirmation") or {}).get("confirmation_url")
+    if not confirmation_url:
+        await query.edit_message_text(
+            "❌ Платёж создан, но платёжная ссылка не пришла. Попробуйте ещё раз позже.",
+            reply_markup=KB_BACK_TO_TARIFFS,
+        )
         return
 
-    if data == "device:add":
+    # Создаем платеж в БД (при двойном нажатии — только один раз)
+    if is_new:
         async with async_session() as session:
-            u: M.User = (await session.execute(select(M.User).where(M.User.tg_id == update.effective_user.id))).scalar_one()
-
-            from datetime import datetime, timezone
-            now = datetime.now(timezone.utc)
-            base_active = bool(u.subscription_until and u.subscription_until > now)
-            if not base_active:
-                await query.edit_message_text(
-                    "❌ Сначала оформите подписку. \n🖥 Доп. устройства можно покупать только при активной подписке.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("💰 К подпискам", callback_data="menu:tariffs")],
-                                    [InlineKeyboardButton("🏠 Меню", callback_data="menu:main")]]),
-                )
-                return
-
-            # посчитаем текущее кол-во базовых и доп.
-            base_count = (await session.execute(
-                select(func.count(M.Device.id)).where(M.Device.user_id == u.id, M.Device.is_extra == False)
-            )).scalar_one()
-            extra_count = (await session.execute(
-                select(func.count(M.Device.id)).where(M.Device.user_id == u.id, M.Device.is_extra == True)
-            )).scalar_one()
-
-            base_quota = u.device_quota or 0
-            extra_active_count = (u.extra_devices_count or 0) if (u.extra_devices_until and u.extra_devices_until > now) else 0
-
-            # Решаем, куда будет относиться новое устройство
-            if base_count < base_quota:
-                # создаём базовое устройство
-                node = await pick_best_node(session)
-                if not node:
-                    await context.bot.send_message(chat_id=update.effective_chat.id, text="⚠️ Нет доступных серверов для создания устройства. \n Обратитесь в поддержку")
-                    return
-
-                name = f"user{u.id}-{base_count+1}"
-                peer = await wg_client.create_client(name=name)
-
-                d = M.Device(
-                    user_id=u.id,
-                    wg_client_id=peer.get("id"),
-                    wg_client_name=name,
-                    is_extra=False,
-                    node_id=node.id
-                )
-                session.add(d)
-                node.load += 1
-                await session.commit()
+            p = Payment(
+                yk_payment_id=pay["id"],
+                user_id=u["id"],
+                status=pay.get("status", "pending"),
+                purpose="TARIFF",
+                amount=t.price,
+                currency=settings.currency,
+                tariff_id=t.id,
+                confirmation_url=confirmation_url,
+                meta=pay.get("metadata") or {},
+            )
+            session.add(p)
+            await session.commit()
 
-                # отсылаем конфиг
-                try:
-                    cfg = await wg_client.get_config(d.wg_client_id)
-                    bio = io.BytesIO(cfg.encode("utf-8"))
-                    bio.name = f"{d.wg_client_name}.conf"
-                    await context.bot.send_document(chat_id=update.effective_chat.id, document=InputFile(bio))
-                except Exception:
-                    await context.bot.send_message(chat_id=update.effective_chat.id, text="⚠️ Устройство создано, но конфиг не получен. Откройте WG-Easy UI.")
+    # тот же now, что и в проверке подписки, — в часовом поясе пользователей
+    end_date = now.astimezone(TZ) + t.days * DAY
+    formatted_date = end_date.strftime("%d.%m.%Y")
+    # Красивый чек-лист
+    check_list_text = ORDER_TEMPLATE.format(
+        name=t.name, days=t.days, formatted_date=formatted_date, max_devices=t.max_devices, price=rub(t.price),
+    )
 
-                await _render_devices_menu(query, update.effective_user.id)
-                return
+    # Кнопки
+    rows = []
+    rows.append([InlineKeyboardButton("💳 Оплатить картой", url=confirmation_url)])
+    
+    if u["balance"] >= t.price:
+        rows.append([InlineKeyboardButton("💳 Оплатить балансом", callback_data=f"paybalance:TARIFF:{t.id}")])
+    
+    rows.append([InlineKeyboardButton("⬅️ К тарифам", callback_data="menu:tariffs")])
+    rows.append([InlineKeyboardButton("🏠 Главное меню", callback_data="menu:main")])
 
-            # базовая квота забита -> можно ли создать доп?
-            if extra_count < extra_active_count:
-                # есть оплаченный слот доп. устройства -> создаём доп
-                name = f"user{u.id}-extra{extra_count+1}"
-                peer = await wg_client.create_client(name=name)
-
-                d = M.Device(
-                    user_id=u.id,
-                    wg_client_id=str(peer.get("id") or peer.get("clientId") or peer.get("_id")),
-                    wg_client_name=peer.get("name", name),
-                    is_extra=True,
-                )
-                session.add(d)
-                await session.commit()
+    # Запускаем проверку платежа
+    watch_payment(query, u["id"], pay["id"], None if is_new else pay["created_at"])
 
-                try:
-                    cfg = await wg_client.get_config(d.wg_client_id)
-                    bio = io.BytesIO(cfg.encode("utf-8"))
-                    bio.name = f"{d.wg_client_name}.conf"
-                    await context.bot.send_document(chat_id=update.effective_chat.id, document=InputFile(bio))
-                except Exception:
-                    await context.bot.send_message(chat_id=update.effective_chat.id, text="⚠️ Устройство создано, но конфиг не получен. Откройте WG-Easy UI.")
+    await query.edit_message_text(
+        check_list_text,
+        reply_markup=InlineKeyboardMarkup(rows),
+        parse_mode="Markdown"
+    )
 
-                await _render_devices_menu(query, update.effective_user.id)
-                return
+async def _cb_menu_devices(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    await _render_devices_menu(query, update.effective_user.id)
+
+# цена доп. слота фиксирована в настройках — текст предложения собираем один раз
+EXTRA_SLOT_OFFER_TEXT = (
+    "🔓 Дополнительных слотов нет.\n"
+    f"➕ Купите новый слот для 1 устройства за {rub(DEVICE_EXTRA)}.\n\n"
+    "⏳ Срок действия: 30 дней.\n"
+    "⏰ Счет действителен: 10 минут\n"
+    "💡 Важно: все купленные доп-слоты имеют _общий_ срок действия. "
+    "Даже если вы купите несколько слотов в разные дни, они истекут одновременно — "
+    "по единой дате «платных слотов» в профиле.\n\n"
+    "⚠️ Если подписка закончится, устройства будут удалены, "
+    "а срок доп-слотов продолжит идти."
+)
 
-            # нет свободных слотов доп. устройств — предлагаем купить
-            from decimal import Decimal
-            price = Decimal(settings.device_extra_price)
-            pay = await yk_client.create_payment(
-                float(price), settings.currency, "Покупка доп. устройства (1 мес.)", settings.yk_return_url,
-                metadata={"tg_id": update.effective_user.id, "purpose": "EXTRA_DEVICE"}
-            )
+async def _offer_extra_slot(update: Update, query, u: M.User):
+    """Слотов не осталось: выставляем счёт за доп. устройство."""
+    price = DEVICE_EXTRA
+    pay, is_new = await get_or_create_payment(u.id, "EXTRA_DEVICE", None, price, lambda: _get_yk_client().create_payment(
+        float(price), settings.currency, "Покупка доп. устройства (1 мес.)", settings.yk_return_url,
+        metadata={"tg_id": update.effective_user.id, "purpose": "EXTRA_DEVICE"}
+    ))
+    confirmation_url = pay.get("confirmation", {}).get("confirmation_url", "")
+    if is_new:
+        async with async_session() as session:
             p = M.Payment(
                 yk_payment_id=pay["id"],
                 user_id=u.id,
                 status=pay.get("status", "pending"),
                 purpose="EXTRA_DEVICE",
-                amount=float(price),
+                amount=price,
                 currency=settings.currency,
-                confirmation_url=pay.get("confirmation", {}).get("confirmation_url", ""),
+                confirmation_url=confirmation_url,
             )
             session.add(p)
             await session.commit()
 
-            rows = []
-            # Если хватает баланса — добавляем кнопку "Оплатить балансом"
-            # Кнопка YooKassa (основная)
-            rows.append([InlineKeyboardButton("💳 Оплатить", url=p.confirmation_url)])
-
-            if Decimal(u.balance) >= price:
-                rows.append([InlineKeyboardButton("💳 Оплатить балансом", callback_data="paybalance:EXTRA_DEVICE:-")])
-
-            if u.id in user_payment_tasks:
-                old_task = user_payment_tasks[u.id]
-                old_task.cancel()  # Отменяем старую задачу
-                try:
-                    await old_task  # Ждем завершения
-                except asyncio.CancelledError:
-                    print(f"⏹️ Предыдущая задача для user {u.id} отменена")
-                except Exception as e:
-                    print(f"⚠️ Ошибка при отмене предыдущей задачи: {e}")
-
-            # Остальные кнопки
-            user_payment_tasks[u.id] = asyncio.create_task(auto_check_payment(query, pay["id"], u.id, yk_client))
-            rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="menu:devices")])
-            rows.append([InlineKeyboardButton("🏠 Меню", callback_data="menu:main")])
+    rows = []
+    # Если хватает баланса — добавляем кнопку "Оплатить балансом"
+    # Кнопка YooKassa (основная)
+    rows.append([InlineKeyboardButton("💳 Оплатить", url=confirmation_url)])
+
+    if u.balance >= price:
+        rows.append([InlineKeyboardButton("💳 Оплатить балансом", callback_data="paybalance:EXTRA_DEVICE:-")])
 
+    # Запускаем проверку платежа
+    watch_payment(query, u.id, pay["id"], None if is_new else pay["created_at"])
+
+    # Остальные кнопки
+    rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="menu:devices")])
+    rows.append([InlineKeyboardButton("🏠 Меню", callback_data="menu:main")])
+
+    await query.edit_message_text(
+        EXTRA_SLOT_OFFER_TEXT,
+        reply_markup=InlineKeyboardMarkup(rows),
+        parse_mode="Markdown",
+    )
+
+async def _cb_device_add(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    async with async_session() as session:
+        # счётчики берём сразу: без подписки они не нужны, но отдельный запрос дороже пары count(*)
+        u, base_count, extra_count = (
+            await session.execute(_STMT_USER_DEVICE_COUNTS, {"tg_id": update.effective_user.id})
+        ).one()
+
+        now = utcnow()
+        base_active = bool(u.subscription_until and u.subscription_until > now)
+        if not base_active:
             await query.edit_message_text(
-                (
-                    "🔓 Дополнительных слотов нет.\n"
-                    f"➕ Купите новый слот для 1 устройства за {rub(price)}.\n\n"
-                    "⏳ Срок действия: 30 дней.\n"
-                    "⏰ Счет действителен: 10 минут\n"
-                    "💡 Важно: все купленные доп-слоты имеют _общий_ срок действия. "
-                    "Даже если вы купите несколько слотов в разные дни, они истекут одновременно — "
-                    "по единой дате «платных слотов» в профиле.\n\n"
-                    "⚠️ Если подписка закончится, устройства будут удалены, "
-                    "а срок доп-слотов продолжит идти."
-                ),
-                reply_markup=InlineKeyboardMarkup(rows),
-                parse_mode="Markdown",
+                "❌ Сначала оформите подписку. \n🖥 Доп. устройства можно покупать только при активной подписке.",
+                reply_markup=KB_NEED_SUBSCRIPTION,
             )
             return
 
-    if data.startswith("device:view:"):
-        try:
-            await query.answer()
-        except Exception:
-            pass
-        _, _, sid = data.split(":")
-        dev_id = int(sid)
-        async with async_session() as session:
-            d = await session.get(M.Device, dev_id)
-        if not d:
-            await query.edit_message_text("❌ Устройство не найдено.", reply_markup=InlineKeyboardMarkup([back_to_main()]))
-            return
-        rows = [
-            [InlineKeyboardButton("📥 Скачать конфиг", callback_data=f"device:cfg:{dev_id}")],
-            [InlineKeyboardButton("🗑 Удалить", callback_data=f"device:del:{dev_id}")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="menu:devices")],
-        ]
-        await query.edit_message_text(f"🖥 Устройство: {d.wg_client_name}", reply_markup=InlineKeyboardMarkup(rows))
-        return
+        base_quota = u.device_quota or 0
+        extra_active_count = (u.extra_devices_count or 0) if (u.extra_devices_until and u.extra_devices_until > now) else 0
 
-    if data.startswith("device:cfg:"):
-        _, _, sid = data.split(":")
-        dev_id = int(sid)
-        async with async_session() as session:
-            d = await session.get(M.Device, dev_id)
-            if not d:
-                await query.edit_message_text("Устройство не найдено.", reply_markup=InlineKeyboardMarkup([back_to_main()]))
+        # Решаем, куда будет относиться новое устройство
+        if base_count < base_quota:
+            # создаём базовое устройство
+            node = await pick_best_node(session)
+            if not node:
+                await context.bot.send_message(chat_id=update.effective_chat.id, text="⚠️ Нет доступных серверов для создания устройства. \n Обратитесь в поддержку")
                 return
+
+            name = f"user{u.id}-{base_count+1}"
+            peer = await get_wg_client().create_client(name=name)
+
+            d = M.Device(
+                user_id=u.id,
+                wg_client_id=peer.get("id"),
+                wg_client_name=name,
+                is_extra=False,
+                node_id=node.id
+            )
+            session.add(d)
+            node.load += 1
+            await session.commit()
+
+            # отсылаем конфиг
             try:
-                cfg = await wg_client.get_config(d.wg_client_id)
-                bio = io.BytesIO(cfg.encode("utf-8")); bio.name = f"{d.wg_client_name}.conf"
-                await context.bot.send_document(chat_id=update.effective_chat.id, document=InputFile(bio))
-            except WGEasyError as e:
-                # Если в тексте есть 404 — значит peer уже удалён в UI
-                if " 404:" in str(e) or "Cannot find" in str(e):
-                    await context.bot.send_message(chat_id=update.effective_chat.id,
-                                                text="Пир отсутствует в WG-Easy. Удаляю запись из базы…")
-                    await session.delete(d)
-                    await session.commit()
-                    # Вернёмся к списку устройств
-                    await _render_devices_menu(query, update.effective_user.id)
-                    return
-                # Любая другая ошибка
-                await context.bot.send_message(chat_id=update.effective_chat.id, text=f"❌ Не удалось получить конфиг: {e}")
-            # остаёмся на экране устройства или обновим меню
+                await _send_wg_config(context, update.effective_chat.id, d)
+            except Exception:
+                await context.bot.send_message(chat_id=update.effective_chat.id, text="⚠️ Устройство создано, но конфиг не получен. Откройте WG-Easy UI.")
+
             await _render_devices_menu(query, update.effective_user.id)
             return
 
-    if data.startswith("device:del:"):
-        try:
-            await query.answer()
-        except Exception:
-            pass
+        # базовая квота забита -> можно ли создать доп?
+        if extra_count < extra_active_count:
+            # есть оплаченный слот доп. устройства -> создаём доп
+            name = f"user{u.id}-extra{extra_count+1}"
+            peer = await get_wg_client().create_client(name=name)
+
+            d = M.Device(
+                user_id=u.id,
+                wg_client_id=str(peer.get("id") or peer.get("clientId") or peer.get("_id")),
+                wg_client_name=peer.get("name", name),
+                is_extra=True,
+            )
+            session.add(d)
+            await session.commit()
 
-        _, _, sid = data.split(":")
-        dev_id = int(sid)
+            try:
+                await _send_wg_config(context, update.effective_chat.id, d)
+            except Exception:
+                await context.bot.send_message(chat_id=update.effective_chat.id, text="⚠️ Устройство создано, но конфиг не получен. Откройте WG-Easy UI.")
 
-        async with async_session() as session:
-            d = await session.get(M.Device, dev_id)
-            if not d:
-                await query.edit_message_text(
-                    "❌ Устройство не найдено.",
-                    reply_markup=InlineKeyboardMarkup([back_to_main()])
-                )
-                return
+            await _render_devices_menu(query, update.effective_user.id)
+            return
 
-            # Берем ноду устройства
-            if d.node_id:
-                node = await session.get(M.Node, d.node_id)
-            else:
-                node = None
-
-            if d.wg_client_id and node:
-                node_client = WGEasyClient(node.api_url, node.api_password)
-                try:
-                    await node_client.delete_client(d.wg_client_id)
-                    # уменьшаем нагрузку на сервер
-                    node.load = max(0, node.load - 1)
-                except Exception as e:
-                    await query.edit_message_text(
-                        f"WG API ошибка при удалении: {e}",
-                        reply_markup=InlineKeyboardMarkup([back_to_main()])
-                    )
-                    return
-                finally:
-                    # обязательно закрываем сессию
-                    await node_client.close()
-
-            await session.delete(d)
-            await session.commit()
+    # нет свободных слотов доп. устройств — предлагаем купить (сессия уже закрыта: счёт в YooKassa
+    # создаётся без занятого соединения с БД)
+    await _offer_extra_slot(update, query, u)
 
-        await query.edit_message_text(
-            "✅ Устройство удалено.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🖥 К устройствам", callback_data="menu:devices")],
-                back_to_main()
-            ]),
-        )
+async def _cb_device_view(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    _, _, sid = data.split(":")
+    dev_id = int(sid)
+    async with async_session() as session:
+        d = await session.get(M.Device, dev_id)
+    if not d:
+        await query.edit_message_text("❌ Устройство не найдено.", reply_markup=KB_BACK_MAIN_ONLY)
         return
-    # ---- PAY BY BALANCE ----
-    if data.startswith("paybalance:"):
-        # форматы: paybalance:TARIFF:<tariff_id>  или  paybalance:EXTRA_DEVICE:-
-        _, purpose, sid = data.split(":")
-        async with async_session() as session:
-            u = (await session.execute(
-                select(User).where(User.tg_id == update.effective_user.id)
-            )).scalar_one()
-
-            from decimal import Decimal
-            from datetime import datetime, timezone
-
-            if purpose == "TARIFF":
-                tariff_id = int(sid)
-                t = await session.get(Tariff, tariff_id)
-                if not t:
-                    await query.edit_message_text("❌ Тариф не найден.", reply_markup=InlineKeyboardMarkup([back_to_main()]))
-                    return
-                price = Decimal(str(t.price))
-                if Decimal(u.balance) < price:
-                    await query.edit_message_text("❌ Недостаточно средств на балансе.", reply_markup=InlineKeyboardMarkup([back_to_main()]))
-                    return
-
-                # списываем
-                u.balance = (Decimal(u.balance) - price)
-
-                # создаём внутренний платеж (succeeded)
-                p = Payment(
-                    yk_payment_id=None,
-                    user_id=u.id,
-                    status="succeeded",
-                    purpose="TARIFF",
-                    amount=float(price),
-                    currency=settings.currency,
-                    tariff_id=t.id,
-                    confirmation_url=None,
-                    meta={"paid_by_balance": True, "used_balance": float(price)},
-                )
-                session.add(p)
-                await session.commit()
+    rows = [
+        [InlineKeyboardButton("📥 Скачать конфиг", callback_data=f"device:cfg:{dev_id}")],
+        [InlineKeyboardButton("🗑 Удалить", callback_data=f"device:del:{dev_id}")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="menu:devices")],
+    ]
+    await query.edit_message_text(f"🖥 Устройство: {d.wg_client_name}", reply_markup=InlineKeyboardMarkup(rows))
 
-                # применяем право
-                await cancel_user_payment_check(u.id)
-                await _apply_successful_payment(session, p)
+async def _cb_device_cfg(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    from app.wg_api import WGEasyError
+    _, _, sid = data.split(":")
+    dev_id = int(sid)
+    async with async_session() as session:
+        d = await session.get(M.Device, dev_id)
+        if not d:
+            await query.edit_message_text("Устройство не найдено.", reply_markup=KB_BACK_MAIN_ONLY)
+            return
+        try:
+            await _send_wg_config(context, update.effective_chat.id, d)
+        except WGEasyError as e:
+            # Если в тексте есть 404 — значит peer уже удалён в UI
+            if " 404:" in str(e) or "Cannot find" in str(e):
+                await context.bot.send_message(chat_id=update.effective_chat.id,
+                                            text="Пир отсутствует в WG-Easy. Удаляю запись из базы…")
+                await session.delete(d)
                 await session.commit()
-
-                await query.edit_message_text(
-                    "✅ Подписка активирована (оплачено балансом)",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 В меню", callback_data="menu:main")]])
-                )
+                # Вернёмся к списку устройств
+                await _render_devices_menu(query, update.effective_user.id)
                 return
+            # Любая другая ошибка
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=f"❌ Не удалось получить конфиг: {e}")
+        # остаёмся на экране устройства или обновим меню
+        await _render_devices_menu(query, update.effective_user.id)
+        return
 
-            if purpose == "EXTRA_DEVICE":
-                price = Decimal(str(settings.device_extra_price))
-                if Decimal(u.balance) < price:
-                    await query.edit_message_text("❌ Недостаточно средств на балансе.", reply_markup=InlineKeyboardMarkup([back_to_main()]))
-                    return
-
-                # списываем
-                u.balance = (Decimal(u.balance) - price)
-
-                p = Payment(
-                    yk_payment_id=None,
-                    user_id=u.id,
-                    status="succeeded",
-                    purpose="EXTRA_DEVICE",
-                    amount=float(price),
-                    currency=settings.currency,
-                    tariff_id=None,
-                    confirmation_url=None,
-                    meta={"paid_by_balance": True, "used_balance": float(price)},
-                )
-                session.add(p)
-                await session.commit()
-                
-                # В обработчике оплаты балансом
-                await cancel_user_payment_check(u.id)
-                await _apply_successful_payment(session, p)
-                await session.commit()
+async def _cb_device_del(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    _, _, sid = data.split(":")
+    dev_id = int(sid)
+
+    async with async_session() as session:
+        # устройство и его нода — одним запросом
+        row = (await session.execute(_STMT_DEVICE_WITH_NODE, {"dev_id": dev_id})).one_or_none()
+        if not row:
+            await query.edit_message_text(
+                "❌ Устройство не найдено.",
+                reply_markup=KB_BACK_MAIN_ONLY
+            )
+            return
+        d, node = row
 
+        if d.wg_client_id and node:
+            try:
+                await (await _get_node_client(node)).delete_client(d.wg_client_id)
+                # уменьшаем нагрузку на сервер
+                node.load = max(0, node.load - 1)
+            except Exception as e:
                 await query.edit_message_text(
-                    "✅ Доп. слот активирован (оплачено балансом)",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🖥 К устройствам", callback_data="menu:devices")]])
+                    f"WG API ошибка при удалении: {e}",
+                    reply_markup=KB_BACK_MAIN_ONLY
                 )
                 return
-    # ---- REF ----
-    if data == "menu:ref":
-        async with async_session() as session:
-            u = (await session.execute(select(User).where(User.tg_id == update.effective_user.id))).scalar_one()
-        me = await context.bot.get_me()
-        deep = f"https://t.me/{me.username}?start={u.referral_code}"
-
-        trial = settings.ref_trial_days
-        ref_fix = settings.ref_referrer_fixed_rub
-
-        txt = (
-            "🎁 Реферальная программа\n\n"
-            f"• Дай другу ссылку: {deep}\n"
-            f"• Новый пользователь получает пробный доступ на {trial} дн. (авто-активация)\n"
-            f"• Ты получаешь {ref_fix} ₽ на баланс сразу\n\n"
-            "Баланс можно использовать для оплаты подписки и доп-устройств.\n"
-            "Если баланса достаточно — появится кнопка «Оплатить балансом»."
-        )
-        await query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup([back_to_main()]))
-        return
 
-    # ---- ADMIN ----
-
-    if data == "menu:admin":
-        # проверим права
-        async with async_session() as session:
-            res = await session.execute(select(User).where(User.tg_id == update.effective_user.id))
-            user = res.scalar_one_or_none()
-        if not user or not user.is_admin:
-            await query.edit_message_text("❌ Недостаточно прав.", reply_markup=InlineKeyboardMarkup([back_to_main()]))
-            return
-        await query.edit_message_text("🛠 Админ-панель", reply_markup=admin_menu())
-        return
+        await session.delete(d)
+        await session.commit()
 
-    if data == "admin:notify":
-        async with async_session() as session:
-            if not await require_admin(update, session):
-                await query.edit_message_text("❌ Недостаточно прав.", reply_markup=InlineKeyboardMarkup([back_to_admin()]))
-                return
-            # сброс состояния
-            context.user_data.pop("notify_scope", None)
-            context.user_data.pop("await_notify_text", None)
-            context.user_data.pop("notify_text", None)
+    await query.edit_message_text(
+        "✅ Устройство удалено.",
+        reply_markup=KB_BACK_TO_DEVICES,
+    )
 
-        text = (
-            "📣 Уведомления\n\n"
-            "Выберите аудиторию ниже."
-        )
-        await query.edit_message_text(text, reply_markup=notify_scope_kb())
-        return
+# ---- PAY BY BALANCE ----
+async def _cb_paybalance(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    # форматы: paybalance:TARIFF:<tariff_id>  или  paybalance:EXTRA_DEVICE:-
+    _, purpose, sid = data.split(":")
+    async with async_session() as session:
+        u = (await session.execute(_STMT_USER_BY_TG, {"tg_id": update.effective_user.id})).scalar_one()
 
-    # 2) Выбор аудитории
-    if data.startswith("admin:notify:scope:"):
-        scope = data.split(":")[3]  # active | inactive | all
-        async with async_session() as session:
-            if not await require_admin(update, session):
-                await query.answer("Нет прав", show_alert=True); return
-            n = await count_recipients(session, scope)
 
-        context.user_data["notify_scope"] = scope
-        context.user_data["await_notify_text"] = True
-        scope_h = "Активные" if scope == "active" else ("Неактивные" if scope == "inactive" else "Все пользователи")
-        text = (
-            "✍️ Текст уведомления\n\n"
-            f"Аудитория: {scope_h} (получателей: {n})\n\n"
-            "Отправьте сообщение одним текстом (Markdown разрешён). "
-            "Шапка «📣 Сообщение от VPN-сервиса» будет добавлена автоматически."
-        )
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="admin:notify")]]))
-        return
+        if purpose == "TARIFF":
+            tariff_id = int(sid)
+            t = await get_active_tariff(tariff_id)
+            if not t:
+                await query.edit_message_text("❌ Тариф не найден.", reply_markup=KB_BACK_MAIN_ONLY)
+                return
+            price = t.price  # Numeric -> уже Decimal
+            # проверка и списание — одним UPDATE (без гонки при двойном клике)
+            if await _debit_balance(session, u.id, price) is None:
+                await query.edit_message_text("❌ Недостаточно средств на балансе.", reply_markup=KB_BACK_MAIN_ONLY)
+                return
 
-    # 3) Подтверждение отправки (после предпросмотра)
-    if data.startswith("admin:notify:confirm:"):
-        # admin:notify:confirm:<send|cancel>
-        action = data.split(":")[3]
-        scope = context.user_data.get("notify_scope")
-        notify_text = context.user_data.get("notify_text")
-        if action == "cancel":
-            # сброс
-            context.user_data.pop("await_notify_text", None)
-            context.user_data.pop("notify_text", None)
-            text = "🚫 Отправка отменена."
-            await query.edit_message_text(text, reply_markup=notify_scope_kb())
-            return
+            # создаём внутренний платеж (succeeded)
+            p = Payment(
+                yk_payment_id=None,
+                user_id=u.id,
+                status="succeeded",
+                purpose="TARIFF",
+                amount=price,
+                currency=settings.currency,
+                tariff_id=t.id,
+                confirmation_url=None,
+                meta={"paid_by_balance": True, "used_balance": float(price)},
+            )
+            # списание, платёж и право — одна транзакция с единственным commit
+            # (_apply_successful_payment не нужен p.id, INSERT уйдёт при commit вместе с остальным)
+            session.add(p)
 
-        if action == "send":
-            if not (scope and notify_text):
-                await query.answer("Нет данных для отправки.", show_alert=True); return
+            # применяем право
+            cancel_user_payment_check(u.id)
+            await _apply_successful_payment(session, p)
+            await session.commit()
 
-            # берём список получателей и шлём
-            async with async_session() as session:
-                if not await require_admin(update, session):
-                    await query.answer("Нет прав", show_alert=True); return
-                ids = await list_recipient_ids(session, scope)
-
-            sent = 0
-            failed = 0
-            header = BOT_BROADCAST_HEADER
-            full_text = f"{header}{notify_text}"
-
-            # аккуратно шлём, уважая rate-limit
-            for tg_id in ids:
-                try:
-                    await context.bot.send_message(tg_id, full_text)
-                    sent += 1
-                except Exception:
-                    failed += 1
-                await asyncio.sleep(0.05)  # лёгкий троттлинг
-
-            # сброс состояния
-            context.user_data.pop("await_notify_text", None)
-            context.user_data.pop("notify_text", None)
-
-            result = (
-                "✅ *Рассылка завершена*\n\n"
-                f"Отправлено: *{sent}*\n"
-                f"Не доставлено: *{failed}*"
+            await query.edit_message_text(
+                "✅ Подписка активирована (оплачено балансом)",
+                reply_markup=KB_TO_MAIN_ONLY
             )
-            await query.edit_message_text(result, reply_markup=notify_scope_kb())
             return
 
-    if data == "admin:users_list":
-        # кнопки действий
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔍 Поиск пользователя", callback_data="admin:users")],
-            back_to_admin()
-        ])
+        if purpose == "EXTRA_DEVICE":
+            price = DEVICE_EXTRA
+            if await _debit_balance(session, u.id, price) is None:
+                await query.edit_message_text("❌ Недостаточно средств на балансе.", reply_markup=KB_BACK_MAIN_ONLY)
+                return
 
-        await query.edit_message_text("👥 Пользователи", reply_markup=kb)
-        return
+            p = Payment(
+                yk_payment_id=None,
+                user_id=u.id,
+                status="succeeded",
+                purpose="EXTRA_DEVICE",
+                amount=price,
+                currency=settings.currency,
+                tariff_id=None,
+                confirmation_url=None,
+                meta={"paid_by_balance": True, "used_balance": float(price)},
+            )
+            session.add(p)
 
-    if data == "admin:users":
-        async with async_session() as session:
-            res = await session.execute(select(User).where(User.tg_id == update.effective_user.id))
-            user = res.scalar_one_or_none()
-            if not user or not user.is_admin:
-                await query.edit_message_text("❌ Недостаточно прав.", reply_markup=InlineKeyboardMarkup([back_to_main()]))
-                return
+            # В обработчике оплаты балансом
+            cancel_user_payment_check(u.id)
+            await _apply_successful_payment(session, p)
+            await session.commit()
 
-        text = (
-            "👥 *Пользователи*\n\n"
-            "Отправьте *точный* `@username` (с @) *или* числовой *ID* пользователя.\n"
-            "Примеры: `@vasya` или `123456789`."
-        )
-        context.user_data["await_user_search_exact"] = True
-        await query.edit_message_text(
-            text
-        )
-        return
+            await query.edit_message_text(
+                "✅ Доп. слот активирован (оплачено балансом)",
+                reply_markup=KB_TO_DEVICES_ONLY
+            )
+            return
+    await _cb_unknown(update, context, query, data)
+
+# ---- REF ----
+# условия программы берутся из настроек один раз; на клик подставляется только ссылка
+REF_TEXT_TEMPLATE = (
+    "🎁 Реферальная программа\n\n"
+    "• Дай другу ссылку: {deep}\n"
+    f"• Новый пользователь получает пробный доступ на {settings.ref_trial_days} дн. (авто-активация)\n"
+    f"• Ты получаешь {settings.ref_referrer_fixed_rub} ₽ на баланс сразу\n\n"
+    "Баланс можно использовать для оплаты подписки и доп-устройств.\n"
+    "Если баланса достаточно — появится кнопка «Оплатить балансом»."
+)
 
-    # открыть карточку профиля из любого места
-    if data.startswith("admin:user:"):
-        uid = int(data.split(":")[2])
-        async with async_session() as session:
-            if not await require_admin(update, session):
-                await query.edit_message_text("❌ Недостаточно прав.", reply_markup=InlineKeyboardMarkup([back_to_admin()]))
-                return
-        await render_user_card_view(query, uid, show_devices=False)
+async def _assign_referral_code(tg_user) -> str:
+    # редкий путь: у пользователя ещё нет кода (старая запись) или нет самой записи
+    async with async_session() as session:
+        code = (await session.execute(
+            update(User).where(User.tg_id == tg_user.id)
+            .values(referral_code=func.coalesce(User.referral_code, gen_ref_code()))
+            .returning(User.referral_code)
+        )).scalar_one_or_none()
+        if code is None:
+            user, _ = await ensure_user(
+                session, tg_id=tg_user.id, username=tg_user.username,
+                first=tg_user.first_name, last=tg_user.last_name,
+            )
+            return user.referral_code
+        await session.commit()
+    return code
+
+async def _cb_menu_ref(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    ref_code = await fetch_referral_code(update.effective_user.id) or await _assign_referral_code(update.effective_user)
+    # username бота закеширован PTB при initialize() — get_me() на каждый клик не нужен
+    deep = f"https://t.me/{context.bot.username}?start={ref_code}"
+    await query.edit_message_text(REF_TEXT_TEMPLATE.format(deep=deep), reply_markup=KB_BACK_MAIN_ONLY)
+
+# ---- ADMIN ----
+async def _cb_menu_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    # проверим права
+    if not await is_admin_tg(update.effective_user.id):
+        await query.edit_message_text("❌ Недостаточно прав.", reply_markup=KB_BACK_MAIN_ONLY)
         return
+    await query.edit_message_text("🛠 Админ-панель", reply_markup=admin_menu())
 
-    # показать/скрыть список устройств в самой карточке
-    if data.startswith("admin:card:toggle_devices:"):
-        _, _, _, uid, state = data.split(":")
-        await render_user_card_view(query, int(uid), show_devices=(state == "0"))
-        return
+async def _cb_admin_notify(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    async with async_session() as session:
+        if not await require_admin(update, session):
+            await query.edit_message_text("❌ Недостаточно прав.", reply_markup=KB_BACK_ADMIN_ONLY)
+            return
+        # сброс состояния
+        context.user_data.pop(NOTIFY_KEY, None)
 
-    # продлить базовую подписку
-    if data.startswith("admin:card:add_days:"):
-        _, _, _, uid, days, state = data.split(":")
-        uid, days, show = int(uid), int(days), (state == "1")
-        async with async_session() as session:
-            if not await require_admin(update, session):
-                await query.answer("Нет прав", show_alert=True); return
-            u = await get_user_by_id(session, uid)
-            if not u:
-                await query.answer("Пользователь не найден", show_alert=True); return
-            from datetime import datetime, timedelta, timezone
-            now = datetime.now(timezone.utc)
-            start = u.subscription_until if (u.subscription_until and u.subscription_until > now) else now
-            u.subscription_until = start + timedelta(days=days)
-            await session.commit()
-        await render_user_card_view(query, uid, show_devices=show)
-        return
+    text = (
+        "📣 Уведомления\n\n"
+        "Выберите аудиторию ниже."
+    )
+    await query.edit_message_text(text, reply_markup=notify_scope_kb())
 
-    # установить квоту
-    if data.startswith("admin:card:set_quota:"):
-        _, _, _, uid, quota, state = data.split(":")
-        uid, quota, show = int(uid), int(quota), (state == "1")
-        async with async_session() as session:
-            if not await require_admin(update, session):
-                await query.answer("Нет прав", show_alert=True); return
-            u = await get_user_by_id(session, uid)
-            if not u:
-                await query.answer("Пользователь не найден", show_alert=True); return
-            u.device_quota = max(0, quota)
-            await session.commit()
-        await render_user_card_view(query, uid, show_devices=show)
-        return
+# 2) Выбор аудитории
+async def _cb_admin_notify_scope(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    scope = data.split(":")[3]  # active | inactive | all
+    async with async_session() as session:
+        if not await require_admin(update, session):
+            await _alert(query, "Нет прав"); return
+        n = await count_recipients(session, scope)
 
-    # отключить базовую подписку
-    if data.startswith("admin:card:deactivate:"):
-        _, _, _, uid, state = data.split(":")
-        uid, show = int(uid), (state == "1")
-        async with async_session() as session:
-            if not await require_admin(update, session):
-                await query.answer("Нет прав", show_alert=True); return
-            u = await get_user_by_id(session, uid)
-            if not u:
-                await query.answer("Пользователь не найден", show_alert=True); return
-            u.subscription_until = None
-            u.device_quota = 0
-            await session.commit()
-        await render_user_card_view(query, uid, show_devices=show)
+    context.user_data[NOTIFY_KEY] = NotifyState(scope)
+    scope_h = "Активные" if scope == "active" else ("Неактивные" if scope == "inactive" else "Все пользователи")
+    text = (
+        "✍️ Текст уведомления\n\n"
+        f"Аудитория: {scope_h} (получателей: {n})\n\n"
+        "Отправьте сообщение одним текстом (Markdown разрешён). "
+        "Шапка «📣 Сообщение от VPN-сервиса» будет добавлена автоматически."
+    )
+    await query.edit_message_text(text, reply_markup=NOTIFY_BACK_MARKUP)
+
+# 3) Подтверждение отправки (после предпросмотра)
+async def run_broadcast(bot, scope: str, full_text: str) -> tuple[int, int]:
+    """Шлёт full_text (уже с шапкой) аудитории scope. Возвращает (отправлено, не доставлено)."""
+    sent = failed = 0
+    send = partial(bot.send_message, text=full_text)
+    if settings.broadcast_channel_id:
+        # публикуем один раз в канал, получателям — copyMessage по id: запрос меньше, повтор идемпотентен
+        try:
+            src = await bot.send_message(settings.broadcast_channel_id, full_text)
+            send = partial(bot.copy_message, from_chat_id=src.chat_id, message_id=src.message_id)
+        except TelegramError as e:
+            log.warning("broadcast channel post failed, sending directly: %s", e)
+    # выборка кладёт id в очередь, BROADCAST_CONCURRENCY воркеров шлют без ожидания «хвоста» пачки
+    queue: asyncio.Queue[int | None] = asyncio.Queue(maxsize=BROADCAST_QUEUE_SIZE)
+
+    async def worker():
+        nonlocal sent, failed
+        while (tg_id := await queue.get()) is not None:
+            if await _send_broadcast_one(send, tg_id):
+                sent += 1
+            else:
+                failed += 1
+
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(BROADCAST_CONCURRENCY):
+            tg.create_task(worker())
+        # получателей читаем пачками и сразу отдаём воркерам; соединение берётся только на время пачки
+        async for batch in iter_recipient_ids(scope):
+            for tg_id in batch:
+                await queue.put(tg_id)
+        for _ in range(BROADCAST_CONCURRENCY):
+            await queue.put(None)
+    return sent, failed
+
+async def _broadcast_and_report(query, scope: str, full_text: str) -> None:
+    try:
+        sent, failed = await run_broadcast(query.get_bot(), scope, full_text)
+    except Exception:
+        log.exception("broadcast failed")
+        await query.edit_message_text("❌ Рассылка прервана из-за ошибки, подробности в логе.", reply_markup=notify_scope_kb())
         return
-
-    # +1 доп-слот (только при активной базе)
-    if data.startswith("admin:card:addons_inc:"):
-        _, _, _, uid, state = data.split(":")
-        uid, show = int(uid), (state == "1")
-        async with async_session() as session:
-            if not await require_admin(update, session):
-                await query.answer("Нет прав", show_alert=True); return
-            u = await get_user_by_id(session, uid)
-            if not u:
-                await query.answer("Пользователь не найден", show_alert=True); return
-            from datetime import datetime, timedelta, timezone
-            now = datetime.now(timezone.utc)
-            base_active = bool(u.subscription_until and u.subscription_until > now)
-            if not base_active:
-                await query.answer("База не активна — доп. слоты нельзя выдать.", show_alert=True)
-                await render_user_card_view(query, uid, show_devices=show)
-                return
-            u.extra_devices_count = max(0, int(u.extra_devices_count or 0) + 1)
-            if not (u.extra_devices_until and u.extra_devices_until > now):
-                u.extra_devices_until = now + timedelta(days=30)
-            await session.commit()
-        await render_user_card_view(query, uid, show_devices=show)
+    result = (
+        "✅ *Рассылка завершена*\n\n"
+        f"Отправлено: *{sent}*\n"
+        f"Не доставлено: *{failed}*"
+    )
+    await query.edit_message_text(result, reply_markup=notify_scope_kb())
+
+async def _cb_admin_notify_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    # admin:notify:confirm:<send|cancel>
+    action = data.split(":")[3]
+    if action == "cancel":
+        # сброс
+        context.user_data.pop(NOTIFY_KEY, None)
+        text = "🚫 Отправка отменена."
+        await query.edit_message_text(text, reply_markup=notify_scope_kb())
         return
 
-    # -1 доп-слот
-    if data.startswith("admin:card:addons_dec:"):
-        _, _, _, uid, state = data.split(":")
-        uid, show = int(uid), (state == "1")
-        async with async_session() as session:
-            if not await require_admin(update, session):
-                await query.answer("Нет прав", show_alert=True); return
-            u = await get_user_by_id(session, uid)
-            if not u:
-                await query.answer("Пользователь не найден", show_alert=True); return
-            u.extra_devices_count = max(0, int(u.extra_devices_count or 0) - 1)
-            await session.commit()
-        await render_user_card_view(query, uid, show_devices=show)
-        return
+    if action == "send":
+        notify = context.user_data.get(NOTIFY_KEY)
+        if notify is None or not notify.text:
+            await _alert(query, "Нет данных для отправки."); return
 
-    # продлить доп-слоты на 30 дней
-    if data.startswith("admin:card:addons_extend:"):
-        _, _, _, uid, state = data.split(":")
-        uid, show = int(uid), (state == "1")
         async with async_session() as session:
             if not await require_admin(update, session):
-                await query.answer("Нет прав", show_alert=True); return
-            u = await get_user_by_id(session, uid)
-            if not u:
-                await query.answer("Пользователь не найден", show_alert=True); return
-            from datetime import datetime, timedelta, timezone
-            now = datetime.now(timezone.utc)
-            start = u.extra_devices_until if (u.extra_devices_until and u.extra_devices_until > now) else now
-            u.extra_devices_until = start + timedelta(days=30)
-            await session.commit()
-        await render_user_card_view(query, uid, show_devices=show)
-        return
+                await _alert(query, "Нет прав"); return
 
-    # сбросить доп-слоты
-    if data.startswith("admin:card:addons_deact:"):
-        _, _, _, uid, state = data.split(":")
-        uid, show = int(uid), (state == "1")
-        async with async_session() as session:
-            if not await require_admin(update, session):
-                await query.answer("Нет прав", show_alert=True); return
-            u = await get_user_by_id(session, uid)
-            if not u:
-                await query.answer("Пользователь не найден", show_alert=True); return
-            u.extra_devices_count = 0
-            u.extra_devices_until = None
-            await session.commit()
-        await render_user_card_view(query, uid, show_devices=show)
-        return
+        # сброс состояния до запуска: повторное нажатие не начнёт вторую рассылку
+        context.user_data.pop(NOTIFY_KEY, None)
 
-    # Переключение периода
-    if data.startswith("admin:payments:period:"):
-        _, _, _, kind = data.split(":")  # today|month|year|all
-        await _render_admin_payments(update.callback_query, update.effective_user.id, kind)
+        # рассылка идёт в фоне, итог допишем в это же сообщение
+        await query.edit_message_text("⏳ Рассылка запущена…")
+        context.application.create_task(_broadcast_and_report(query, notify.scope, notify.text), name="broadcast")
         return
+    await _cb_unknown(update, context, query, data)
 
-    if data == "admin:payments_list":
-        # кнопки действий
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("💰 Статистика платежей", callback_data="admin:payments")],
-            back_to_admin()
-        ])
+async def _cb_admin_users_list(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    await query.edit_message_text("👥 Пользователи", reply_markup=ADMIN_USERS_LIST_MARKUP)
 
-        await query.edit_message_text("💳 Платежи", reply_markup=kb)
+async def _cb_admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    if not await is_admin_tg(update.effective_user.id):
+        await query.edit_message_text("❌ Недостаточно прав.", reply_markup=KB_BACK_MAIN_ONLY)
         return
 
-    if data == "admin:payments":
-        await _render_admin_payments(update.callback_query, update.effective_user.id, "today")
-        return
+    text = (
+        "👥 *Пользователи*\n\n"
+        "Отправьте *точный* `@username` (с @) *или* числовой *ID* пользователя.\n"
+        "Примеры: `@vasya` или `123456789`."
+    )
+    context.user_data["await_user_search_exact"] = True
+    await query.edit_message_text(
+        text
+    )
 
-    if data == "admin:stats":
-        # права проверим как и в 'menu:admin'
-        async with async_session() as session:
-            res = await session.execute(select(User).where(User.tg_id == update.effective_user.id))
-            admin = res.scalar_one_or_none()
-        if not admin or not admin.is_admin:
-            await query.edit_message_text("❌ Недостаточно прав.", reply_markup=InlineKeyboardMarkup([back_to_admin()]))
+# открыть карточку профиля из любого места
+async def _cb_admin_user(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    uid = int(data.split(":")[2])
+    async with async_session() as session:
+        if not await require_admin(update, session):
+            await query.edit_message_text("❌ Недостаточно прав.", reply_markup=KB_BACK_ADMIN_ONLY)
             return
-        from datetime import datetime, timezone
-        # сразу покажем сводку + кнопки
-        async with async_session() as session:
-            now = datetime.now(timezone.utc)
-
-            # все пользователи
-            all_users = (await session.execute(select(func.count(User.id)))).scalar_one()
-
-            # активные пользователи: есть базовая подписка ИЛИ активны доп. слоты
-            users_active = (await session.execute(
-                select(func.count(User.id)).where(
-                    or_(
-                        and_(User.subscription_until.is_not(None), User.subscription_until > now),
-                        and_(User.extra_devices_until.is_not(None), User.extra_devices_until > now),
-                    )
-                )
-            )).scalar_one()
+    await render_user_card_view(query, uid, show_devices=False)
 
-            users_inactive = all_users - users_active
+# показать/скрыть список устройств в самой карточке
+async def _cb_admin_card_toggle_devices(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    _, _, _, uid, state = data.split(":")
+    await render_user_card_view(query, int(uid), show_devices=(state == "0"))
 
-            # активные устройства (enabled = true)
-            active_devices = (await session.execute(
-                select(func.count(Device.id)).where(Device.enabled.is_(True))
-            )).scalar_one()
+def _extend_sql(col, delta: timedelta, now: datetime):
+    """_extend_from на стороне БД: продление от текущего конца или от now, без чтения строки."""
+    return case((col > now, col), else_=now) + delta
 
-        text = (
-            "📊 *Статистика*\n\n"
-            f"👥 Всего пользователей: *{all_users}*\n"
-            f"🟢 Активных пользователей: *{users_active}*\n"
-            f"⚪️ Неактивных пользователей: *{users_inactive}*\n"
-            f"🖥 Активных устройств: *{active_devices}*"
+async def _admin_card_update(query, uid: int, show: bool, values: dict, *where) -> None:
+    # точечный UPDATE ... RETURNING id вместо загрузки всей строки User ради 1–2 полей
+    async with async_session() as session:
+        if not await is_admin_tg(query.from_user.id, session):
+            await _alert(query, "Нет прав"); return
+        stmt = update(User).where(User.id == uid, *where).values(**values).returning(User.id)
+        if (await session.execute(stmt)).scalar_one_or_none() is None:
+            # строка не обновилась: либо пользователя нет, либо не выполнено условие where
+            exists = await session.scalar(select(User.id).where(User.id == uid))
+            if exists is None:
+                await _alert(query, "Пользователь не найден"); return
+            await _alert(query, "База не активна — доп. слоты нельзя выдать.")
+        else:
+            await session.commit()
+    await render_user_card_view(query, uid, show_devices=show)
+
+# продлить базовую подписку
+async def _cb_admin_card_add_days(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    _, _, _, uid, days, state = data.split(":")
+    await _admin_card_update(query, int(uid), state == "1", {
+        "subscription_until": _extend_sql(User.subscription_until, int(days) * DAY, utcnow()),
+    })
+
+# установить квоту
+async def _cb_admin_card_set_quota(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    _, _, _, uid, quota, state = data.split(":")
+    await _admin_card_update(query, int(uid), state == "1", {"device_quota": max(0, int(quota))})
+
+# отключить базовую подписку
+async def _cb_admin_card_deactivate(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    _, _, _, uid, state = data.split(":")
+    await _admin_card_update(query, int(uid), state == "1", {
+        "subscription_until": None,
+        "device_quota": 0,
+    })
+
+# +1 доп-слот (только при активной базе — условие прямо в WHERE)
+async def _cb_admin_card_addons_inc(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    _, _, _, uid, state = data.split(":")
+    now = utcnow()
+    await _admin_card_update(query, int(uid), state == "1", {
+        "extra_devices_count": func.coalesce(User.extra_devices_count, 0) + 1,
+        "extra_devices_until": case(
+            (User.extra_devices_until > now, User.extra_devices_until), else_=now + EXTRA_DEVICE_PERIOD,
+        ),
+    }, User.subscription_until > now)
+
+# -1 доп-слот
+async def _cb_admin_card_addons_dec(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    _, _, _, uid, state = data.split(":")
+    await _admin_card_update(query, int(uid), state == "1", {
+        "extra_devices_count": func.greatest(func.coalesce(User.extra_devices_count, 0) - 1, 0),
+    })
+
+# продлить доп-слоты на 30 дней
+async def _cb_admin_card_addons_extend(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    _, _, _, uid, state = data.split(":")
+    await _admin_card_update(query, int(uid), state == "1", {
+        "extra_devices_until": _extend_sql(User.extra_devices_until, EXTRA_DEVICE_PERIOD, utcnow()),
+    })
+
+# сбросить доп-слоты
+async def _cb_admin_card_addons_deact(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    _, _, _, uid, state = data.split(":")
+    await _admin_card_update(query, int(uid), state == "1", {
+        "extra_devices_count": 0,
+        "extra_devices_until": None,
+    })
+
+# Переключение периода
+async def _cb_admin_payments_period(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    _, _, _, kind = data.split(":")  # today|month|year|all
+    await _render_admin_payments(update.callback_query, update.effective_user.id, kind)
+
+async def _cb_admin_payments_list(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    await query.edit_message_text("💳 Платежи", reply_markup=ADMIN_PAYMENTS_LIST_MARKUP)
+
+async def _cb_admin_payments(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    await _render_admin_payments(update.callback_query, update.effective_user.id, "today")
+
+async def _cb_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str):
+    # права проверим как и в 'menu:admin'
+    if not await is_admin_tg(update.effective_user.id):
+        await query.edit_message_text("❌ Недостаточно прав.", reply_markup=KB_BACK_ADMIN_ONLY)
+        return
+    # сразу покажем сводку + кнопки
+    async with async_session() as session:
+        # все / активные / неактивные — те же, что у рассылки, + активные устройства — одним запросом
+        all_users, users_active, users_inactive, active_devices = await count_recipients_all(
+            session, with_devices=True
         )
 
-        kb = InlineKeyboardMarkup([
-            back_to_admin()
-        ])
-        await query.edit_message_text(text, reply_markup=kb, parse_mode="Markdown")
+    text = (
+        "📊 *Статистика*\n\n"
+        f"👥 Всего пользователей: *{all_users}*\n"
+        f"🟢 Активных пользователей: *{users_active}*\n"
+        f"⚪️ Неактивных пользователей: *{users_inactive}*\n"
+        f"🖥 Активных устройств: *{active_devices}*"
+    )
+
+    await query.edit_message_text(text, reply_markup=KB_BACK_ADMIN_ONLY, parse_mode="Markdown")
+
+# Точные callback_data — один поиск в словаре
+CALLBACK_HANDLERS = {
+    "menu:help": _cb_menu_help,
+    "help:how": _cb_help_how,
+    "help:troubleshoot": _cb_help_troubleshoot,
+    "help:devices": _cb_help_devices,
+    "help:addons": _cb_help_addons,
+    "help:support": _cb_help_support,
+    "menu:main": _cb_menu_main,
+    "menu:tariffs": _cb_menu_tariffs,
+    "menu:devices": _cb_menu_devices,
+    "device:add": _cb_device_add,
+    "menu:ref": _cb_menu_ref,
+    "menu:admin": _cb_menu_admin,
+    "admin:notify": _cb_admin_notify,
+    "admin:users_list": _cb_admin_users_list,
+    "admin:users": _cb_admin_users,
+    "admin:payments_list": _cb_admin_payments_list,
+    "admin:payments": _cb_admin_payments,
+    "admin:stats": _cb_admin_stats,
+}
+# callback_data с параметрами: ключ — всё до последнего «:» перед параметрами
+# (admin:card:add_days:<uid>:<days>:<s> -> "admin:card:add_days:")
+CALLBACK_PREFIX_HANDLERS = {
+    "tariff:buy:": _cb_tariff_buy,
+    "device:view:": _cb_device_view,
+    "device:cfg:": _cb_device_cfg,
+    "device:del:": _cb_device_del,
+    "paybalance:": _cb_paybalance,
+    "admin:notify:scope:": _cb_admin_notify_scope,
+    "admin:notify:confirm:": _cb_admin_notify_confirm,
+    "admin:user:": _cb_admin_user,
+    "admin:card:toggle_devices:": _cb_admin_card_toggle_devices,
+    "admin:card:add_days:": _cb_admin_card_add_days,
+    "admin:card:set_quota:": _cb_admin_card_set_quota,
+    "admin:card:deactivate:": _cb_admin_card_deactivate,
+    "admin:card:addons_inc:": _cb_admin_card_addons_inc,
+    "admin:card:addons_dec:": _cb_admin_card_addons_dec,
+    "admin:card:addons_extend:": _cb_admin_card_addons_extend,
+    "admin:card:addons_deact:": _cb_admin_card_addons_deact,
+    "admin:payments:period:": _cb_admin_payments_period,
+}
+
+# маршруты, которые сами показывают alert (через _alert) — им фоновый пустой ответ помешал бы
+CALLBACK_ALERTING_HANDLERS = frozenset({
+    _cb_admin_notify_scope,
+    _cb_admin_notify_confirm,
+    _cb_admin_card_add_days,
+    _cb_admin_card_set_quota,
+    _cb_admin_card_deactivate,
+    _cb_admin_card_addons_inc,
+    _cb_admin_card_addons_dec,
+    _cb_admin_card_addons_extend,
+    _cb_admin_card_addons_deact,
+})
+
+# ответы на callback в фоне: держим ссылки, чтобы задачи не собрал GC
+_answer_tasks: set[asyncio.Task] = set()
+
+def _answer_done(task: asyncio.Task) -> None:
+    _answer_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        # устаревший query и т.п. — на обработку нажатия не влияет
+        log.debug("callback answer failed: %s", task.exception())
+
+def _prefix_handler(data: str):
+    # пробуем префиксы по каждому «:» — несколько поисков в словаре вместо перебора всей таблицы
+    i = data.find(":")
+    while i != -1:
+        handler = CALLBACK_PREFIX_HANDLERS.get(data[:i + 1])
+        if handler is not None:
+            return handler
+        i = data.find(":", i + 1)
+    return None
+
+async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data or ""
+    # точное совпадение -> префикс по «:» -> catch-all
+    handler = CALLBACK_HANDLERS.get(data) or _prefix_handler(data) or _cb_unknown
+
+    if handler not in CALLBACK_ALERTING_HANDLERS:
+        # «часики» на кнопке снимаем, не дожидаясь ответа Telegram
+        task = asyncio.create_task(query.answer())
+        _answer_tasks.add(task)
+        task.add_done_callback(_answer_done)
+        await handler(update, context, query, data)
         return
 
-    # catch-all
-    await query.edit_message_text("Неизвестное действие.", reply_markup=InlineKeyboardMarkup([back_to_main()]))
+    # маршрут может ответить alert'ом сам: второй ответ на тот же query Telegram отклонит,
+    # поэтому пустой ответ шлём только после хендлера и только если alert'а не было
+    try:
+        await handler(update, context, query, data)
+    finally:
+        if query.id in _alerted:
+            _alerted.discard(query.id)
+        else:
+            try:
+                await query.answer()
+            except TelegramError as e:
+                log.debug("callback answer failed: %s", e)
 
 # ---------------------------
 # Background polling (optional)
 # ---------------------------
 
-async def _apply_successful_payment(session: AsyncSession, p: Payment) -> None:
+async def _preload_payment_targets(
+    session: AsyncSession, payments: list[Payment],
+) -> dict[int, tuple[User, Optional[Tariff]]]:
+    # пользователи и тарифы пачки платежей — один SELECT вместо пары session.get на каждый.
+    # Объекты отдаём явно: identity map держит их слабо, без ссылок они бы сразу выгрузились
+    if not payments:
+        return {}
+    rows = (await session.execute(_STMT_PAYMENT_TARGETS, {"pids": [p.id for p in payments]})).all()
+    return {pid: (u, t) for pid, u, t in rows}
+
+async def _apply_successful_payment(
+    session: AsyncSession, p: Payment, u: Optional[User] = None, t: Optional[Tariff] = None,
+) -> None:
     """
     Обновляет состояние пользователя по успешному платежу.
     - TARIFF: продлеваем базовую подписку, выставляем квоту устройств по тарифу.
     - TOPUP: пополняем баланс (если решишь опять использовать).
     - EXTRA_DEVICE: увеличиваем подписку на доп. устройства (помесячно), наращиваем счётчик.
+    u/t — уже загруженные владелец и тариф (_preload_payment_targets); иначе читаются здесь.
     """
-    u = await session.get(User, p.user_id)
+    if u is None:
+        u = await session.get(User, p.user_id)
 
     if p.purpose == "TARIFF" and p.tariff_id:
-        t = await session.get(Tariff, p.tariff_id)
-        now = datetime.now(timezone.utc)
+        if t is None:
+            t = await session.get(Tariff, p.tariff_id)
+        now = utcnow()
 
         # продлеваем/включаем базовую подписку
-        sub_until = u.subscription_until or now
-        if sub_until < now:
-            sub_until = now
-        sub_until = sub_until + timedelta(days=t.days)
-        u.subscription_until = sub_until
+        u.subscription_until = _extend_from(u.subscription_until, t.days * DAY, now)
 
         # квота устройств по тарифу
         u.device_quota = t.max_devices
 
         # реферальный бонус (если используешь)
         if u.referred_by_user_id:
-            bonus = (Decimal(p.amount) * Decimal(     # p.amount — float -> Decimal
-                getattr(__import__("app.config", fromlist=["settings"]).config.settings, "referral_bonus_percent", 0)
-            ) / Decimal(100)).quantize(Decimal("0.01"))
-            ref_user = await session.get(User, u.referred_by_user_id)
-            ref_user.balance = (Decimal(ref_user.balance or 0) + bonus)
+            bonus = (p.amount * REF_BONUS_FRACTION).quantize(CENT)
+            await session.execute(
+                update(User).where(User.id == u.referred_by_user_id)
+                .values(balance=User.balance + bonus)
+            )
 
     elif p.purpose == "TOPUP":
-        u.balance = (Decimal(u.balance or 0) + Decimal(p.amount))
+        u.balance = (u.balance or ZERO) + p.amount
 
     elif p.purpose == "EXTRA_DEVICE":
-        now = datetime.now(timezone.utc)
+        now = utcnow()
 
         # активный период доп. устройств: +30 дней от текущего конца (или от сейчас, если не активно)
-        current_until = u.extra_devices_until or now
-        if current_until < now:
-            current_until = now
-        u.extra_devices_until = current_until + timedelta(days=30)
+        u.extra_devices_until = _extend_from(u.extra_devices_until, EXTRA_DEVICE_PERIOD, now)
 
         # увеличиваем количество оплаченных доп. устройств
         u.extra_devices_count = (u.extra_devices_count or 0) + 1
 
+POLL_YK_CONCURRENCY = 10
+
 async def poll_pending_payments(context: ContextTypes.DEFAULT_TYPE):
+    # 1) короткая сессия: только список ожидающих
     async with async_session() as session:
-        res = await session.execute(select(Payment).where(Payment.status == "pending").order_by(Payment.created_at).limit(20))
-        pending = res.scalars().all()
-        for p in pending:
-            try:
-                info = await yk_client.get_payment(p.yk_payment_id)
-            except Exception:
-                continue
-            status = info.get("status", "pending")
-            if status != p.status:
-                p.status = status
-                p.updated_at = datetime.now(timezone.utc)
-                if status == "succeeded":
-                    await _apply_successful_payment(session, p)
+        pending = (await session.execute(_STMT_PENDING_PAYMENTS)).all()
+    if not pending:
+        return
+
+    # 2) статусы YooKassa — параллельно, без открытой сессии
+    yk = _get_yk_client()
+    sem = asyncio.Semaphore(POLL_YK_CONCURRENCY)
+
+    async def fetch(yk_id: str):
+        async with sem:
+            return await yk.get_payment(yk_id)
+
+    infos = await asyncio.gather(*(fetch(r.yk_payment_id) for r in pending), return_exceptions=True)
+    changed = [
+        (r.id, info.get("status", "pending"))
+        for r, info in zip(pending, infos)
+        if not isinstance(info, BaseException) and info.get("status", "pending") != "pending"
+    ]
+    if not changed:
+        return
+
+    # 3) новая сессия только под изменившиеся; переход только из pending —
+    # если payment_watchdog успел раньше, второй раз не применяем
+    ts = utcnow()
+    by_status: dict[str, list[int]] = {}
+    for pid, status in changed:
+        by_status.setdefault(status, []).append(pid)
+    async with async_session() as session:
+        # один UPDATE на статус, а не на каждый платёж
+        succeeded: list[Payment] = []
+        for status, ids in by_status.items():
+            moved = (await session.execute(
+                update(Payment).where(Payment.id.in_(ids), Payment.status == "pending")
+                .values(status=status, updated_at=ts)
+                .returning(Payment)
+            )).scalars().all()
+            if status == "succeeded":
+                succeeded = moved
+        targets = await _preload_payment_targets(session, succeeded)
+        for p in succeeded:
+            await _apply_successful_payment(session, p, *targets[p.id])
         await session.commit()
 
 # ---------------------------
@@ -0,0 +1,33 @@
+import aiohttp
+
+# Общий пул HTTP-соединений процесса (WG-Easy, YooKassa): keep-alive и TLS-сессии
+# переиспользуются между запросами вместо нового рукопожатия на каждый вызов.
+_connector: aiohttp.TCPConnector | None = None
+http_session: aiohttp.ClientSession | None = None
+
+def get_connector() -> aiohttp.TCPConnector:
+    """Общий коннектор. Вызывать только внутри запущенного event loop."""
+    global _connector
+    if _connector is None or _connector.closed:
+        _connector = aiohttp.TCPConnector(limit=100, limit_per_host=30, ttl_dns_cache=300, keepalive_timeout=60)
+    return _connector
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Общая сессия для клиентов без собственного состояния (YooKassa).
+    Клиентам с cookie-авторизацией (WG-Easy) нужна своя сессия поверх get_connector(),
+    иначе несколько нод на одном хосте перетирали бы друг другу cookie.
+    """
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(connector=get_connector(), connector_owner=False)
+    return http_session
+
+async def close_http() -> None:
+    global _connector, http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    if _connector is not None and not _connector.closed:
+        await _connector.close()
+    http_session = None
+    _connector = None
@@ -1,11 +1,19 @@
 from __future__ import annotations
 from datetime import datetime, timezone
+from decimal import Decimal
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy import BigInteger, ForeignKey, String, Boolean, Numeric, JSON, Text, DateTime, Integer
+from sqlalchemy import BigInteger, Computed, ForeignKey, Index, String, Boolean, Numeric, JSON, Text, DateTime, Integer, text
 from app.database import Base
 
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        # INCLUDE id, tg_id: keyset-пачки рассылки «активным» (id > последний, отдаём tg_id)
+        # читаются только из индекса (index-only scan)
+        Index("ix_users_active_until_tg", "active_until", postgresql_include=["id", "tg_id"]),
+        # поиск в админке по @username без учёта регистра: where lower(username) = ...
+        Index("ix_users_username_lower", text("lower(username)")),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     tg_id: Mapped[int] = mapped_column(BigInteger, unique=True, nullable=False)
@@ -14,7 +22,7 @@ class User(Base):
     first_name: Mapped[str | None] = mapped_column(String(255))
     last_name: Mapped[str | None] = mapped_column(String(255))
 
-    balance: Mapped[float] = mapped_column(Numeric(12, 2), default=0)
+    balance: Mapped[Decimal] = mapped_column(Numeric(12, 2), default=0)
 
     is_admin: Mapped[bool] = mapped_column(Boolean, default=False)
     referral_code: Mapped[str | None] = mapped_column(String(64), unique=True)
@@ -31,6 +39,12 @@ class User(Base):
     extra_devices_until: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
     extra_devices_count: Mapped[int] = mapped_column(Integer, default=0)
 
+    # до какого момента активен хоть какой-то доступ (база или доп. слоты); считает сама БД
+    active_until: Mapped[datetime | None] = mapped_column(
+        DateTime(timezone=True),
+        Computed("GREATEST(subscription_until, extra_devices_until)", persisted=True),
+    )
+
     # СТАРОЕ ПОЛЕ (если оно ещё есть в схеме) — можно оставить, но не использовать:
     # extra_devices: Mapped[int] = mapped_column(Integer, default=0)
 
@@ -44,19 +58,20 @@ class User(Base):
     devices: Mapped[list["Device"]] = relationship(back_populates="user")
     payments: Mapped[list["Payment"]] = relationship(back_populates="user")
 
-    def has_base_active(self) -> bool:
+    # now можно передать снаружи, чтобы все проверки запроса шли от одного момента
+    def has_base_active(self, now: datetime | None = None) -> bool:
         if not self.subscription_until:
             return False
-        return self.subscription_until > datetime.now(timezone.utc)
+        return self.subscription_until > (now or datetime.now(timezone.utc))
 
-    def has_extra_active(self) -> bool:
+    def has_extra_active(self, now: datetime | None = None) -> bool:
         if not self.extra_devices_until:
             return False
-        return self.extra_devices_until > datetime.now(timezone.utc)
+        return self.extra_devices_until > (now or datetime.now(timezone.utc))
 
-    def total_quota(self) -> int:
+    def total_quota(self, now: datetime | None = None) -> int:
         base = self.device_quota or 0
-        extra = self.extra_devices_count if self.has_extra_active() else 0
+        extra = self.extra_devices_count if self.has_extra_active(now) else 0
         return base + extra
 
 class Tariff(Base):
@@ -64,7 +79,7 @@ class Tariff(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(100))
     days: Mapped[int] = mapped_column(Integer)
-    price: Mapped[float] = mapped_column(Numeric(12,2))
+    price: Mapped[Decimal] = mapped_column(Numeric(12,2))
     max_devices: Mapped[int] = mapped_column(Integer)
     is_active: Mapped[bool] = mapped_column(Boolean, default=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow)
@@ -88,12 +103,20 @@ class Device(Base):
 
 class Payment(Base):
     __tablename__ = "payments"
+    # отчёт по периоду (status + created_at) и очередь pending (id, yk_payment_id) читаются только из индекса
+    __table_args__ = (
+        Index(
+            "ix_payments_status_created", "status", "created_at",
+            postgresql_include=["id", "amount", "purpose", "yk_payment_id"],
+        ),
+    )
+
     id: Mapped[int] = mapped_column(primary_key=True)
     yk_payment_id: Mapped[str | None] = mapped_column(String(255), unique=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
     status: Mapped[str] = mapped_column(String(50))    # pending, succeeded, canceled
     purpose: Mapped[str] = mapped_column(String(50))   # TARIFF, TOPUP, EXTRA_DEVICE
-    amount: Mapped[float] = mapped_column(Numeric(12,2))
+    amount: Mapped[Decimal] = mapped_column(Numeric(12,2))
     currency: Mapped[str] = mapped_column(String(10), default="RUB")
     tariff_id: Mapped[int | None] = mapped_column(ForeignKey("tariffs.id", ondelete="SET NULL"))
     confirmation_url: Mapped[str | None] = mapped_column(Text)
@@ -105,6 +128,8 @@ class Payment(Base):
 
 class Node(Base):
     __tablename__ = "nodes"
+    # выбор наименее загруженной активной ноды (pick_best_node) идёт по этому индексу
+    __table_args__ = (Index("ix_nodes_active_load", "load", postgresql_where=text("is_active")),)
 
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(100), unique=True)  # название сервера
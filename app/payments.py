@@ -1,19 +1,25 @@
 import base64
 import uuid
 import aiohttp
+import orjson
 from typing import Any, Dict, Optional
 
+from app.http import get_http_session
+
 class YooKassaError(Exception):
     pass
 
 class YooKassaClient:
     API_URL = "https://api.yookassa.ru/v3"
 
-    def __init__(self, shop_id: str, secret_key: str):
+    def __init__(self, shop_id: str, secret_key: str, *, session: Optional[aiohttp.ClientSession] = None):
         self.shop_id = shop_id
         self.secret_key = secret_key
         token = f"{shop_id}:{secret_key}".encode()
         self._basic = base64.b64encode(token).decode()
+        # None — берём общую сессию процесса при первом запросе
+        self._session = session
+        self._timeout = aiohttp.ClientTimeout(total=30)
 
     async def _request(self, method: str, path: str, *, idempotence_key: str | None = None, **kwargs):
         url = f"{self.API_URL}{path}"
@@ -22,13 +28,15 @@ class YooKassaClient:
         if idempotence_key:
             headers["Idempotence-Key"] = idempotence_key
         headers.setdefault("Content-Type", "application/json")
-        timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.request(method, url, headers=headers, **kwargs) as resp:
-                data = await resp.json(content_type=None)
-                if resp.status >= 400:
-                    raise YooKassaError(f"{resp.status}: {data}")
-                return data
+        session = self._session or get_http_session()
+        if "json" in kwargs:
+            kwargs["data"] = orjson.dumps(kwargs.pop("json"))
+        async with session.request(method, url, headers=headers, timeout=self._timeout, **kwargs) as resp:
+            body = await resp.read()
+            data = orjson.loads(body) if body.strip() else None
+            if resp.status >= 400:
+                raise YooKassaError(f"{resp.status}: {data}")
+            return data
 
     async def create_payment(self, amount: float, currency: str, description: str, return_url: str, metadata: Optional[Dict[str, Any]] = None ) -> Dict[str, Any]:
         idem = str(uuid.uuid4())
@@ -1,7 +1,7 @@
 from __future__ import annotations
 from decimal import Decimal
 from typing import Optional
-from uuid import uuid4
+import secrets
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes
@@ -39,4 +39,5 @@ def pop_stack(context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
     return stack[-1] if stack else None
 
 def gen_ref_code() -> str:
-    return uuid4().hex[:8]
+    # 6 случайных байт -> ровно 8 url-safe символов (подходят для deep-link ?start=)
+    return secrets.token_urlsafe(6)[:8]
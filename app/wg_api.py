@@ -1,14 +1,26 @@
 from __future__ import annotations
 
 import aiohttp
+import orjson
 from aiohttp import ClientSession, ClientTimeout
 from typing import Any, Dict, Optional, Iterable, Tuple
 
+from app.http import get_connector
+
 
 class WGEasyError(Exception):
     pass
 
 
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+async def _read_json(resp: aiohttp.ClientResponse) -> Any:
+    # orjson заметно быстрее stdlib json; пустое тело (204 и т.п.) -> None
+    body = await resp.read()
+    return orjson.loads(body) if body.strip() else None
+
+
 async def _safe_text(resp: aiohttp.ClientResponse) -> str:
     try:
         return await resp.text()
@@ -36,16 +48,20 @@ class WGEasyClient:
 
     # ---------- auth/session ----------
 
+    def _new_session(self) -> ClientSession:
+        # своя cookie-сессия, но соединения — из общего пула процесса
+        return aiohttp.ClientSession(timeout=self._timeout, connector=get_connector(), connector_owner=False)
+
     async def _ensure_raw_session(self) -> ClientSession:
         if self._session is None or self._session.closed:
-            self._session = aiohttp.ClientSession(timeout=self._timeout)
+            self._session = self._new_session()
         return self._session
 
     async def _login(self) -> None:
         # Cookie-сессия через /api/session
         sess = await self._ensure_raw_session()
         url = f"{self.base_url}/api/session"
-        async with sess.post(url, json={"password": self.password}) as resp:
+        async with sess.post(url, data=orjson.dumps({"password": self.password}), headers=_JSON_HEADERS) as resp:
             if resp.status not in (200, 204):
                 detail = await _safe_text(resp)
                 raise WGEasyError(f"Login failed: {resp.status} {detail}")
@@ -53,7 +69,7 @@ class WGEasyClient:
 
     async def _ensure_session(self) -> ClientSession:
         if self._session is None or self._session.closed:
-            self._session = aiohttp.ClientSession(timeout=self._timeout)
+            self._session = self._new_session()
         if not self._logged_in:
             await self._login()
         return self._session
@@ -129,7 +145,7 @@ class WGEasyClient:
             ("GET", "/api/clients", {}),
         ]
         resp = await self._try_variants(variants)
-        data = await resp.json(content_type=None)
+        data = await _read_json(resp)
         await resp.release()
         if isinstance(data, dict) and "clients" in data and isinstance(data["clients"], list):
             return data["clients"]
@@ -147,7 +163,7 @@ class WGEasyClient:
         тело: {"name": "..."}
         На всякий — оставляем и другие варианты.
         """
-        json_payload = {"json": {"name": name}}
+        json_payload = {"data": orjson.dumps({"name": name}), "headers": _JSON_HEADERS}
         form_payload = {"data": {"name": name}}
 
         variants = [
@@ -168,7 +184,7 @@ class WGEasyClient:
         ]
 
         resp = await self._try_variants(variants)
-        data = await resp.json(content_type=None)
+        data = await _read_json(resp)
         await resp.release()
 
         # Подстрахуемся: если id не вернули — найдём по имени
@@ -183,9 +199,9 @@ class WGEasyClient:
 
         return data
 
-    async def get_config(self, client_id: str) -> str:
+    async def get_config(self, client_id: str) -> bytes:
         """
-        Получить конфиг клиента.
+        Получить конфиг клиента (сырые байты — их можно сразу отдавать файлом).
 
         Актуально для новых версий: GET /api/wireguard/client/{id}/configuration
         (раньше многие примеры писали /config — из-за этого у тебя и был 404)
@@ -204,9 +220,9 @@ class WGEasyClient:
             ("GET", f"/api/clients/{client_id}/config", {}),
         ]
         resp = await self._try_variants(variants)
-        text = await resp.text()
+        body = await resp.read()
         await resp.release()
-        return text
+        return body
 
     async def delete_client(self, client_id: str) -> None:
         variants = [
@@ -1,21 +1,20 @@
 # bot.py — чистый async запуск PTB v22
 import asyncio
+import logging
 import signal
 from typing import Optional
 from sqlalchemy import select
 from telegram.ext import Application
 from app.database import async_session
 from app.config import settings
-from app.database import init_db
-from app.handlers import register_handlers, poll_pending_payments
+from app.database import init_db, close_pg_pool, wait_for_db
+from app.http import close_http
+from app.handlers import register_handlers, poll_pending_payments, close_wg_clients, get_wg_client
 import app.models as M
 from app.handlers import enforce_user_devices
 from app.config import settings
-from app.wg_api import WGEasyClient
 from datetime import datetime, timezone
 
-wg_client = WGEasyClient(settings.wg_url, settings.wg_password)
-
 async def sync_access_loop():
     while True:
         try:
@@ -30,7 +29,7 @@ async def sync_access_loop():
                     #    f"extra_until={getattr(u,'extra_devices_until',None)} "
                     #    f"extra_cnt={getattr(u,'extra_devices_count',0)}"
                     #)
-                    await enforce_user_devices(session, wg_client, u)
+                    await enforce_user_devices(session, get_wg_client(), u)
         except Exception as e:
             print(f"[sync_access_loop] error: {e}")
         await asyncio.sleep(15)
@@ -75,7 +74,11 @@ def _setup_signal_handlers(loop: asyncio.AbstractEventLoop, stop_event: asyncio.
 
 
 async def main() -> None:
-    # 1) Инициализируем БД ДО старта поллинга
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)  # не пишем каждый getUpdates
+
+    # 1) Инициализируем БД ДО старта поллинга (в docker postgres может подняться позже бота)
+    await wait_for_db()
     await init_db()
 
     # 2) Собираем приложение PTB
@@ -114,8 +117,17 @@ async def main() -> None:
         await app.updater.stop()
         await app.stop()
         await app.shutdown()
+        await close_wg_clients()
+        await close_http()
+        await close_pg_pool()
         print("Bot stopped.")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        # libuv-цикл: бот почти целиком ждёт сеть (Telegram, YooKassa, БД) — сокетные операции дешевле
+        import uvloop
+    except ImportError:  # Windows или uvloop не установлен — обычный asyncio
+        asyncio.run(main())
+    else:
+        uvloop.run(main())